@@ -3,6 +3,7 @@ Schema of aquisition information.
 '''
 import re
 import os
+import pathlib
 from datetime import datetime
 
 import numpy as np
@@ -46,6 +47,21 @@ class Session(dj.Manual):
         """
 
 
+@schema
+class SourceFile(dj.Manual):
+    definition = """ # manifest of the ingested data files, identified by their size, mtime and content hash
+    data_type: enum('extracellular', 'whole_cell')
+    file_name: varchar(255)    # name of the file in its data directory
+    ---
+    file_size: bigint unsigned  # (byte)
+    file_mtime: double          # (s) modification time since epoch
+    file_hash: char(40)         # sha1 hash of the file content
+    -> [nullable] Session
+    ingest_status: enum('ingested', 'changed')  # "changed": content differs from the ingested file, needs re-ingest
+    ingest_time = CURRENT_TIMESTAMP: timestamp
+    """
+
+
 @schema
 class TrialSet(dj.Imported):
     definition = """
@@ -77,4 +93,164 @@ class TrialSet(dj.Imported):
 
     def make(self, key):
         # this function implements the ingestion of Trial data into the pipeline
-        return None
+        # find the data file of this session, in either the extracellular or the intracellular data directory
+        for data_dir in ('extracellular_directory', 'intracellular_directory'):
+            if not dj.config['custom'].get(data_dir):
+                continue
+            sess_data_dir = pathlib.Path(dj.config['custom'].get(data_dir)).as_posix()
+            sess_data_file = utilities.get_session_index(sess_data_dir).lookup(key['subject_id'], key['session_time'])
+            if sess_data_file is not None:
+                break
+        else:
+            raise FileNotFoundError(f'TrialSet import failed for: {key["subject_id"]} - {key["session_time"]}')
+
+        with utilities.h5_file_pool.borrow(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            self.insert_trials(nwb, key, utilities.get_session_index(sess_data_dir).which_data)
+
+    def insert_trials(self, nwb, key, which_data):
+        # read all trials of an NWB file ("extracellular" or "whole_cell") as arrays,
+        # and insert the TrialSet, Trial, EventTime (and TrialPhotoStimInfo) rows in bulk, in one transaction
+        from . import stimulation, analysis
+
+        key = {k: key[k] for k in self.primary_key}
+        trials, event_times, photostim_info = (read_extracellular_trials(nwb) if which_data == 'extracellular'
+                                               else read_wholecell_trials(nwb))
+        # as Python values - DataJoint passes NumPy scalars (e.g. np.bool_) on as strings, rejected by MySQL
+        trials, event_times, photostim_info = (
+            {k: np.asarray(v).tolist() for k, v in columns.items()} if columns is not None else None
+            for columns in (trials, event_times, photostim_info))
+        trial_ids = trials['trial_id']
+        with utilities.transaction(self.connection):
+            self.insert1(dict(key, trial_counts=len(trial_ids)), allow_direct_insert=True)
+            self.Trial.insert((dict(key, **{k: v[idx] for k, v in trials.items()})
+                               for idx in range(len(trial_ids))), allow_direct_insert=True)
+            self.EventTime.insert((dict(key, trial_id=trial_id, trial_event=event, event_time=times[idx])
+                                   for event, times in event_times.items()
+                                   for idx, trial_id in enumerate(trial_ids)), allow_direct_insert=True)
+            if photostim_info is not None:
+                stimulation.TrialPhotoStimInfo.insert((dict(key, trial_id=trial_id,
+                                                            **{k: v[idx] for k, v in photostim_info.items()})
+                                                       for idx, trial_id in enumerate(trial_ids)),
+                                                      allow_direct_insert=True)
+        analysis.event_time_cache.invalidate(key)
+        analysis.segmentation_cache.invalidate()
+        print(f'Inserted trial set of {len(trial_ids)} trials for: Subject: {key["subject_id"]} - '
+              f'Date: {key["session_time"]}')
+
+
+# ---- trial ingestion from the NWB files ----
+
+trial_id_pattern = re.compile(r'\d+')
+tag_patterns = dict(is_good=re.compile('good', re.I),
+                    is_non_stim=re.compile('non-stimulation', re.I),
+                    trial_type=re.compile('Hit|Err|NoLick'),
+                    trial_response=re.compile('Hit|Err|NoLick|LickEarly'),
+                    photo_stim_type=re.compile('PhotoStimulation|PhotoInhibition', re.I))
+# map the hardcoded trial description (from 'reference.TrialType')
+trial_type_choices = {'L': 'lick left', 'R': 'lick right'}
+# map the hardcoded trial description (from 'reference.TrialResponse')
+trial_resp_choices = {'Hit': 'correct', 'Err': 'incorrect', 'NoLick': 'no response', 'LickEarly': 'early lick'}
+photostim_period_choices = np.array(['N/A', 'sample', 'delay', 'response'])
+cue_duration = 0.1  # hard-coded the fact that an auditory cue last 0.1 second (extracellular dataset)
+
+
+def _decode(s):
+    return s.decode('UTF-8') if isinstance(s, bytes) else s
+
+
+def classify_tag(tag):
+    # classify one trial descriptor tag (keywords are not in fixed order among the tags of a trial)
+    m_type = tag_patterns['trial_type'].match(tag)
+    m_resp = tag_patterns['trial_response'].match(tag)
+    m_stim = tag_patterns['photo_stim_type'].match(tag)
+    return (tag_patterns['is_good'].match(tag) is not None,
+            tag_patterns['is_non_stim'].match(tag) is not None,
+            trial_type_choices[tag[m_type.end()]] if m_type else None,
+            trial_resp_choices[m_resp.group()] if m_resp else None,
+            m_stim.group().replace('Photo', '').lower() if m_stim else None)
+
+
+def _first_per_trial(values, tag_trial_idx, trial_count, default, last=False):
+    # value of the first (or last) tag of each trial having one (not None), "default" otherwise
+    column = np.full(trial_count, default, dtype=object)
+    has_value = np.array([v is not None for v in values], dtype=bool)
+    idx = np.flatnonzero(has_value)
+    if last:
+        idx = idx[::-1]
+    trial_idx, first = np.unique(tag_trial_idx[idx], return_index=True)
+    column[trial_idx] = values[idx[first]]
+    return column
+
+
+def read_extracellular_trials(nwb):
+    # trial descriptors of the extracellular dataset, from the tags of the epochs and "trial_type_mat"
+    trial_names = list(nwb['epochs'])
+    trial_count = len(trial_names)
+    tags = [[_decode(t) for t in nwb['epochs'][name]['tags'].value] for name in trial_names]
+    trials = dict(trial_id=np.array([int(trial_id_pattern.search(name).group()) for name in trial_names]),
+                  start_time=np.array([nwb['epochs'][name]['start_time'].value for name in trial_names]),
+                  stop_time=np.array([nwb['epochs'][name]['stop_time'].value for name in trial_names]))
+
+    # -- classify each distinct tag once, then reduce the tags of each trial
+    tag_trial_idx = np.repeat(np.arange(trial_count), [len(t) for t in tags])
+    flat_tags = np.array([t for trial_tags in tags for t in trial_tags], dtype=object)
+    unique_tags, tag_inverse = np.unique(flat_tags.astype(str), return_inverse=True)
+    classified = np.empty((len(unique_tags), 5), dtype=object)
+    for idx, tag in enumerate(unique_tags):
+        classified[idx] = classify_tag(tag)
+    classified = classified[tag_inverse.ravel()]
+
+    trials['trial_is_good'] = np.bincount(tag_trial_idx[classified[:, 0].astype(bool)],
+                                          minlength=trial_count) > 0
+    trials['trial_stim_present'] = np.bincount(tag_trial_idx[classified[:, 1].astype(bool)],
+                                               minlength=trial_count) == 0
+    trials['trial_type'] = _first_per_trial(classified[:, 2], tag_trial_idx, trial_count, 'non-performing')
+    # trial response: "early lick" if any, else the response of the last tag having one
+    trial_response = _first_per_trial(classified[:, 3], tag_trial_idx, trial_count, 'N/A', last=True)
+    is_early_lick = np.bincount(tag_trial_idx[classified[:, 3] == 'early lick'], minlength=trial_count) > 0
+    trial_response[is_early_lick] = 'early lick'
+    trials['trial_response'] = trial_response
+
+    # -- events timing
+    presentation = nwb['stimulus']['presentation']
+    cue_start_times = np.array(presentation['auditory_cue']['timestamps'])
+    event_times = dict(trial_start=trials['start_time'],
+                       trial_stop=trials['stop_time'],
+                       cue_start=cue_start_times,
+                       cue_end=cue_start_times + cue_duration,  # hard-coded cue_end time here
+                       pole_in=np.array(presentation['pole_in']['timestamps']),
+                       pole_out=np.array(presentation['pole_out']['timestamps']))
+
+    # -- trial stimulation descriptors, from the last 5 rows of "trial_type_mat"
+    trial_type_mat = np.array(nwb['analysis']['trial_type_mat'])
+    photostim_info = dict(photo_stim_type=_first_per_trial(classified[:, 4], tag_trial_idx, trial_count, 'N/A'),
+                          photo_stim_period=photostim_period_choices[trial_type_mat[-5, :].astype(int)],
+                          photo_stim_power=trial_type_mat[-4, :],
+                          photo_loc_galvo_x=trial_type_mat[-3, :],
+                          photo_loc_galvo_y=trial_type_mat[-2, :],
+                          photo_loc_galvo_z=trial_type_mat[-1, :])
+    return trials, event_times, photostim_info
+
+
+def read_wholecell_trials(nwb):
+    # trial descriptors of the whole-cell dataset, from "good_trials" and the trial codes of "trial_type_mat"
+    trial_names = list(nwb['epochs'])
+    trial_code = np.array(nwb['analysis']['trial_type_mat'].value).astype(bool)
+    trials = dict(trial_id=np.array([int(trial_id_pattern.search(name).group()) for name in trial_names]),
+                  start_time=np.array([nwb['epochs'][name]['start_time'].value for name in trial_names]),
+                  stop_time=np.array([nwb['epochs'][name]['stop_time'].value for name in trial_names]),
+                  trial_is_good=np.array(nwb['analysis']['good_trials'].value).flatten()[:len(trial_names)] == 1,
+                  trial_type=np.select([trial_code[:, 1] | trial_code[:, 3], trial_code[:, 0] | trial_code[:, 2]],
+                                       ['lick left', 'lick right'], default='non-performing'),
+                  trial_response=np.select([trial_code[:, 4], trial_code[:, 0] | trial_code[:, 1],
+                                            trial_code[:, 2] | trial_code[:, 3], trial_code[:, 5]],
+                                           ['early lick', 'correct', 'incorrect', 'no response'], default='N/A'),
+                  trial_stim_present=trial_code[:, -1])
+
+    # -- events timing
+    presentation = nwb['stimulus']['presentation']
+    event_times = dict(trial_start=trials['start_time'],
+                       trial_stop=trials['stop_time'],
+                       **{event: np.array(presentation[event]['timestamps'])
+                          for event in ('cue_start', 'cue_end', 'pole_in', 'pole_out')})
+    return trials, event_times, None
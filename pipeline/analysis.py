@@ -4,6 +4,7 @@ Schema of analysis data.
 '''
 import re
 import os
+from collections import OrderedDict
 from datetime import datetime
 
 import numpy as np
@@ -43,23 +44,38 @@ class RealignedEvent(dj.Computed):
         realigned_event_time = null: float   # (s) event time with respect to the event this trial-segmentation is time-locked to
         """
         
+    # realign all trials of a trial set at once, for each setting
+    key_source = TrialSegmentationSetting * acquisition.TrialSet
+
     def make(self, key):
-        self.insert1(key)
-        # get event, pre/post stim duration
-        event_of_interest, pre_stim_dur, post_stim_dur = (TrialSegmentationSetting & key).fetch1(
-            'event', 'pre_stim_duration', 'post_stim_duration')
-        # get event time
-        try: 
-            eoi_time_point = get_event_time(event_of_interest, key)
-        except EventChoiceError as e:
-            print(f'Event Choice error - Msg: {str(e)}')
-            return
-        # get all other events for this trial
-        events, event_times = (acquisition.TrialSet.EventTime & key).fetch('trial_event', 'event_time')
-        self.RealignedEventTime.insert(dict(key,
-                                            trial_event=eve,
-                                            realigned_event_time=event_times[e_idx] - eoi_time_point)
-                                       for e_idx, eve in enumerate(events))
+        # get event
+        event_of_interest = (TrialSegmentationSetting & key).fetch1('event')
+        # get all events of all trials
+        session = event_time_cache.get_session(key)
+        trial_ids, events, event_times, has_event = (session['trial_ids'], session['events'],
+                                                     session['event_times'], session['has_event'])
+        if 'trial_id' in key:
+            trial_idx = trial_ids == key['trial_id']
+            trial_ids, event_times, has_event = trial_ids[trial_idx], event_times[trial_idx], has_event[trial_idx]
+
+        # realign all events with respect to the event of interest
+        if event_of_interest in events:
+            eoi_time_points = event_times[:, events.index(event_of_interest)]
+        else:
+            eoi_time_points = np.full(len(trial_ids), np.nan)
+        realigned_event_times = event_times - eoi_time_points[:, None]
+        is_valid = ~np.isnan(eoi_time_points)
+        if not is_valid.all():
+            print(f'Event Choice error - Msg: {event_of_interest}: event not found or event_time is nan '
+                  f'for {np.sum(~is_valid)} trial(s)')
+
+        with utilities.transaction(self.connection):
+            self.insert(dict(key, trial_id=trial_id) for trial_id in trial_ids)
+            trial_idx, event_idx = np.nonzero(has_event & is_valid[:, None])
+            self.RealignedEventTime.insert(
+                dict(key, trial_id=trial_ids[t_idx], trial_event=events[e_idx],
+                     realigned_event_time=realigned_event_times[t_idx, e_idx])
+                for t_idx, e_idx in zip(trial_idx, event_idx))
 
 
 def perform_trial_segmentation(trial_key, event_name, pre_stim_dur, post_stim_dur, data, fs, first_time_point):
@@ -72,7 +88,7 @@ def perform_trial_segmentation(trial_key, event_name, pre_stim_dur, post_stim_du
         pre_stim_dur = float(pre_stim_dur)
         post_stim_dur = float(post_stim_dur)
         # check if pre/post stim dur is within start/stop time, if not, pad with NaNs
-        trial_start, trial_stop = (acquisition.TrialSet.Trial & trial_key).fetch1('start_time', 'stop_time')
+        trial_start, trial_stop = get_trial_bounds(trial_key)
 
         pre_stim_nan_count = 0
         post_stim_nan_count = 0
@@ -97,16 +113,244 @@ def perform_trial_segmentation(trial_key, event_name, pre_stim_dur, post_stim_du
         return segmented_data
        
 
+def segment_start_samples(event_times, fs, first_time_point, pre_stim_dur):
+    # sample index of the first sample of the segment of each trial - truncated, as in perform_trial_segmentation
+    return ((np.asarray(event_times, dtype=float) - first_time_point) * fs - float(pre_stim_dur) * fs).astype(np.int64)
+
+
+def perform_trial_segmentation_batch(data, fs, first_time_point, event_times, trial_starts, trial_stops,
+                                     pre_stim_dur, post_stim_dur):
+    # segment "data" around the event time of all trials at once, into a preallocated (trial x sample) matrix
+    # each row starts at the sample int((event_time - first_time_point) * fs - pre_stim_dur * fs), as in
+    # perform_trial_segmentation, and spans round(pre_stim_dur * fs) + round(post_stim_dur * fs) + 1 samples,
+    # samples out of the trial start/stop time (or out of the recording) are NaN
+    n_samples = int(round(float(pre_stim_dur) * fs)) + int(round(float(post_stim_dur) * fs)) + 1
+    event_times = np.asarray(event_times, dtype=float)
+    segmented_data = np.full((len(event_times), n_samples), np.nan, dtype=np.result_type(data.dtype, np.float32))
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.any():
+        return segmented_data
+
+    # sample index of the first column of each row, and the range of valid samples of each trial
+    seg_starts = np.zeros(len(event_times), dtype=np.int64)
+    seg_starts[is_valid] = segment_start_samples(event_times[is_valid], fs, first_time_point, pre_stim_dur)
+    trial_starts = np.where(np.isnan(trial_starts), first_time_point, trial_starts)
+    trial_stops = np.where(np.isnan(trial_stops), np.inf, trial_stops)
+    first_samples = np.maximum(np.ceil((trial_starts - first_time_point) * fs - 1e-6), 0)
+    last_samples = np.minimum(np.floor((trial_stops - first_time_point) * fs + 1e-6), len(data) - 1)
+    from_idx = np.maximum(seg_starts, first_samples).astype(np.int64)
+    to_idx = np.minimum(seg_starts + n_samples, last_samples + 1).astype(np.int64)
+
+    out_of_bound = is_valid & ((from_idx > seg_starts) | (to_idx < seg_starts + n_samples))
+    if out_of_bound.any():
+        print(f'Warning: Out of bound pre/poststimulus duration for {np.sum(out_of_bound)} trial(s), padded with NaNs')
+
+    # copy the in-bound slice of each trial in place
+    for i in np.flatnonzero(is_valid & (to_idx > from_idx)):
+        segmented_data[i, from_idx[i] - seg_starts[i]:to_idx[i] - seg_starts[i]] = data[from_idx[i]:to_idx[i]]
+    return segmented_data
+
+
+def perform_session_trial_segmentation(key, fs, first_time_point, traces, max_bytes=None, source=None):
+    # segment each of "traces" around the event of the trial-segmentation setting in "key", for all trials in "key"
+    # trials are segmented in chunks of at most "max_bytes" (default: "insert_batch_bytes" in dj.config['custom']
+    # - np.inf for a single chunk of all trials),
+    # yield (trial_ids, [segmented trace of each of "traces"]) for each chunk
+    # with "source" (a hashable id of the traces), each chunk is segmented at the widest window of the settings sharing
+    # this event and cached, and the one of this setting is sliced from it - the cached chunks stay within
+    # "insert_batch_bytes", also for a single chunk of all trials (concatenated from the sliced chunks)
+    event_name, pre_stim_dur, post_stim_dur, widest_pre_stim_dur, widest_post_stim_dur, is_shared = \
+        get_superset_window(key)
+    trial_ids, event_times, trial_starts, trial_stops = get_trials_event_time(event_name, key)
+
+    is_cached = source is not None and is_shared
+    single_chunk = max_bytes is not None and np.isinf(max_bytes)
+    if is_cached:
+        # a few samples past the widest window: the first sample of a narrower window may be a sample off the
+        # widest window's, its last sample must still be in it
+        widest_post_stim_dur += 3 / fs
+        seg_pre_stim_dur, seg_post_stim_dur = widest_pre_stim_dur, widest_post_stim_dur
+        if single_chunk:
+            max_bytes = None
+    else:
+        seg_pre_stim_dur, seg_post_stim_dur = pre_stim_dur, post_stim_dur
+    n_samples = int(round(pre_stim_dur * fs)) + int(round(post_stim_dur * fs)) + 1
+
+    max_bytes = max_bytes or dj.config['custom'].get('insert_batch_bytes', utilities.default_insert_batch_bytes)
+    trial_nbytes = 8 * len(traces) * (int(round(seg_pre_stim_dur * fs)) + int(round(seg_post_stim_dur * fs)) + 1)
+    chunk_size = max(1, len(trial_ids) if np.isinf(max_bytes) else int(max_bytes // trial_nbytes))
+    chunks = []
+    for chunk_start in range(0, max(len(trial_ids), 1), chunk_size):  # at least one (empty) chunk
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+
+        def segment():
+            segmented_traces = [perform_trial_segmentation_batch(trace, fs, first_time_point, event_times[chunk],
+                                                                 trial_starts[chunk], trial_stops[chunk],
+                                                                 seg_pre_stim_dur, seg_post_stim_dur)
+                                for trace in traces]
+            return segmented_traces, sum(t.nbytes for t in segmented_traces)
+
+        if not is_cached:
+            yield trial_ids[chunk], segment()[0]
+            continue
+
+        widest_segmented_traces = segmentation_cache.get(
+            (source, event_name, widest_pre_stim_dur, widest_post_stim_dur, key.get('trial_id'),
+             chunk_start, chunk_size), segment)
+        # column of each sample of this setting's segment in the widest segment, for each trial
+        col_starts = (segment_start_samples(event_times[chunk], fs, first_time_point, pre_stim_dur)
+                      - segment_start_samples(event_times[chunk], fs, first_time_point, widest_pre_stim_dur))
+        rows, cols = np.arange(len(col_starts))[:, None], col_starts[:, None] + np.arange(n_samples)
+        segmented_traces = [t[rows, cols] for t in widest_segmented_traces]
+        if single_chunk:
+            chunks.append(segmented_traces)
+        else:
+            yield trial_ids[chunk], segmented_traces
+
+    if chunks:
+        yield trial_ids, [np.concatenate(segmented_trace) for segmented_trace in zip(*chunks)]
+
+
+def get_source_id(table, key):
+    # hashable id of the entry of "table" in "key", e.g. the source of a segmentation cached in "segmentation_cache"
+    return (table.full_table_name,) + tuple(key[k] for k in table.primary_key)
+
+
+def get_superset_window(key):
+    # event and pre/post stim duration of the trial-segmentation setting in "key",
+    # the widest pre/post stim duration among all settings sharing this event, and whether any other setting does
+    event_name, pre_stim_dur, post_stim_dur = (TrialSegmentationSetting & key).fetch1(
+        'event', 'pre_stim_duration', 'post_stim_duration')
+    pre_stim_durs, post_stim_durs = (TrialSegmentationSetting & {'event': event_name}).fetch(
+        'pre_stim_duration', 'post_stim_duration')
+    return (event_name, float(pre_stim_dur), float(post_stim_dur),
+            float(max(pre_stim_durs)), float(max(post_stim_durs)), len(pre_stim_durs) > 1)
+
+
+class SegmentationCache:
+    '''
+    In-memory cache of segmentations at the widest window of the settings sharing an event, from which the segmentation
+     of each narrower setting is sliced
+    Least recently used entries are dropped beyond "max_bytes" in total, a larger segmentation is not cached
+    '''
+
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # cache key -> (value, nbytes)
+
+    def get(self, cache_key, compute):
+        # cached value of "cache_key", else computed with "compute()" returning (value, nbytes)
+        if cache_key in self._entries:
+            self._entries.move_to_end(cache_key)
+            return self._entries[cache_key][0]
+        value, nbytes = compute()
+        if nbytes > self.max_bytes:
+            return value
+        self._entries[cache_key] = (value, nbytes)
+        while sum(n for _, n in self._entries.values()) > self.max_bytes:
+            self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        self._entries.clear()
+
+
+segmentation_cache = SegmentationCache(max_bytes=dj.config['custom'].get('segmentation_cache_bytes', 512 * 1024 ** 2))
+
+
+class EventTimeCache:
+    '''
+    In-memory cache of the trial event times of whole sessions
+    Each session is loaded in one query into a dense (trial x event) matrix - NaN for missing entries - along with the
+     start/stop time of each trial, and lookups are served from memory
+    At most "max_sessions" sessions are kept, least recently used first out; call "invalidate()" after (re)ingesting trials
+    '''
+
+    def __init__(self, max_sessions=16):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session key -> dict(trial_ids, events, event_times, has_event,
+        #                                                     trial_starts, trial_stops)
+
+    @staticmethod
+    def _session_key(key):
+        return tuple(key[k] for k in acquisition.TrialSet.primary_key)
+
+    def get_session(self, key):
+        session_key = self._session_key(key)
+        if session_key in self._sessions:
+            self._sessions.move_to_end(session_key)
+            return self._sessions[session_key]
+
+        session_restriction = dict(zip(acquisition.TrialSet.primary_key, session_key))
+        trial_ids, trial_starts, trial_stops = (acquisition.TrialSet.Trial & session_restriction).fetch(
+            'trial_id', 'start_time', 'stop_time', order_by='trial_id')
+        event_trial_ids, event_names, event_times = (acquisition.TrialSet.EventTime & session_restriction).fetch(
+            'trial_id', 'trial_event', 'event_time')
+        events = sorted(set(event_names))
+        event_idx = {e: idx for idx, e in enumerate(events)}
+        entry_idx = (np.searchsorted(trial_ids, event_trial_ids), [event_idx[e] for e in event_names])
+        event_time_matrix = np.full((len(trial_ids), len(events)), np.nan)
+        event_time_matrix[entry_idx] = event_times.astype(float)
+        has_event = np.zeros((len(trial_ids), len(events)), dtype=bool)  # whether the EventTime entry exists
+        has_event[entry_idx] = True
+
+        self._sessions[session_key] = dict(trial_ids=trial_ids, events=events,
+                                           event_times=event_time_matrix, has_event=has_event,
+                                           trial_starts=trial_starts.astype(float),
+                                           trial_stops=trial_stops.astype(float))
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+        return self._sessions[session_key]
+
+    def get_trials(self, event_name, key):
+        # event time, start and stop time of all trials in "key" (one trial if "key" has a trial_id)
+        session = self.get_session(key)
+        trial_idx = (np.flatnonzero(session['trial_ids'] == key['trial_id']) if 'trial_id' in key
+                     else np.arange(len(session['trial_ids'])))
+        event_times = (session['event_times'][trial_idx, session['events'].index(event_name)]
+                       if event_name in session['events'] else np.full(len(trial_idx), np.nan))
+        return (session['trial_ids'][trial_idx], event_times,
+                session['trial_starts'][trial_idx], session['trial_stops'][trial_idx])
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._sessions.clear()
+        else:
+            self._sessions.pop(self._session_key(key), None)
+
+
+event_time_cache = EventTimeCache(max_sessions=dj.config['custom'].get('event_time_cache_size', 16))
+
+
+def get_trials_event_time(event_name, key):
+    # event time, start and stop time of all trials in "key" - trials with missing or nan event time are dropped
+    trial_ids, event_times, trial_starts, trial_stops = event_time_cache.get_trials(event_name, key)
+    is_valid = ~np.isnan(event_times)
+    if not is_valid.all():
+        print(f'{event_name}: event not found or event_time is nan for {np.sum(~is_valid)} trial(s), skipped')
+    return trial_ids[is_valid], event_times[is_valid], trial_starts[is_valid], trial_stops[is_valid]
+
+
+def get_trial_bounds(key):
+    # start and stop time of the trial in "key"
+    _, _, trial_starts, trial_stops = event_time_cache.get_trials(None, key)
+    if len(trial_starts) != 1:
+        raise dj.DataJointError(f'Trial not found: {key}')
+    return trial_starts[0], trial_stops[0]
+
+
 def get_event_time(event_name, key):
     # get event time
-    try:
-        t = (acquisition.TrialSet.EventTime & key & {'trial_event': event_name}).fetch1('event_time')
-    except:
-        raise EventChoiceError(event_name, f'{event_name}: event not found')  
-    if np.isnan(t):
+    session = event_time_cache.get_session(key)
+    trial_idx = np.flatnonzero(session['trial_ids'] == key['trial_id'])
+    if len(trial_idx) != 1 or event_name not in session['events'] or not session['has_event'][
+            trial_idx[0], session['events'].index(event_name)]:
+        raise EventChoiceError(event_name, f'{event_name}: event not found')
+    t = session['event_times'][trial_idx, session['events'].index(event_name)]
+    if np.isnan(t[0]):
         raise EventChoiceError(event_name, msg=f'{event_name}: event_time is nan')
     else:
-        return t
+        return t[0]
     
     
 class EventChoiceError(Exception):
@@ -8,7 +8,6 @@ import pathlib
 import numpy as np
 import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 
 from . import reference, subject, utilities, stimulation, acquisition, analysis
 
@@ -38,12 +37,12 @@ class LickTrace(dj.Imported):
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
             raise FileNotFoundError(f'BehaviorAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
         #  ============= Now read the data and start ingesting =============
         print('Insert behavioral data for: subject: {0} - date: {1}'.format(key['subject_id'], key['session_time']))
-        key['lick_trace_left'] = nwb['acquisition']['timeseries']['lick_trace_L']['data'].value
-        key['lick_trace_right'] = nwb['acquisition']['timeseries']['lick_trace_R']['data'].value
-        lick_trace_time_stamps = nwb['acquisition']['timeseries']['lick_trace_R']['timestamps'].value
+        with utilities.h5_file_pool.borrow(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            key['lick_trace_left'] = nwb['acquisition']['timeseries']['lick_trace_L']['data'].value
+            key['lick_trace_right'] = nwb['acquisition']['timeseries']['lick_trace_R']['data'].value
+            lick_trace_time_stamps = nwb['acquisition']['timeseries']['lick_trace_R']['timestamps'].value
         key['lick_trace_start_time'] = lick_trace_time_stamps[0]
         key['lick_trace_sampling_rate'] = 1 / np.mean(np.diff(lick_trace_time_stamps))
         self.insert1(key)
@@ -74,3 +73,29 @@ class TrialSegmentedLickTrace(dj.Computed):
                                                                lt_right, fs, first_time_point)
         self.LickTrace.insert1(key)
         print(f'Perform trial-segmentation of lick traces for trial: {key["trial_id"]}')
+
+
+@schema
+class TrialSegmentedLickTraceMatrix(dj.Computed):
+    definition = """ # lick traces of all trials of a session, segmented into one (trial x sample) matrix
+    -> LickTrace
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob             # (trial) id of the trial of each row
+    segmented_lt_left: longblob     # (trial x sample), NaN where out of the trial
+    segmented_lt_right: longblob    # (trial x sample), NaN where out of the trial
+    """
+
+    key_source = (LickTrace * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
+    def make(self, key):
+        # get raw
+        fs, first_time_point, lt_left, lt_right = (LickTrace & key).fetch1(
+            'lick_trace_sampling_rate', 'lick_trace_start_time', 'lick_trace_left', 'lick_trace_right')
+        # segmentation
+        (trial_ids, (segmented_lt_left, segmented_lt_right)), = analysis.perform_session_trial_segmentation(
+            key, fs, first_time_point, (lt_left, lt_right), max_bytes=np.inf,
+            source=analysis.get_source_id(LickTrace, key))
+        self.insert1(dict(key, trial_ids=trial_ids,
+                          segmented_lt_left=segmented_lt_left, segmented_lt_right=segmented_lt_right))
+        print(f'Perform trial-segmentation of lick traces for {len(trial_ids)} trials')
@@ -5,10 +5,10 @@ import re
 import os
 from datetime import datetime
 import pathlib
+import functools
 import numpy as np
 import scipy.io as sio
 import datajoint as dj
-import h5py as h5
 import tqdm
 
 from . import reference, utilities, acquisition, analysis
@@ -67,32 +67,90 @@ class UnitSpikeTimes(dj.Imported):
         if sess_data_file is None:
             print(f'UnitSpikeTimes import failed for: {animal_id} - {date_of_experiment}')
             return
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
-        # ------ Spike ------
-        ec_event_waveform = nwb['processing']['extracellular_units']['EventWaveform']
-        ec_unit_times = nwb['processing']['extracellular_units']['UnitTimes']
-        # - unit cell type
-        cell_type = {}
-        for tmp_str in ec_unit_times.get('cell_types').value:
-            tmp_str = tmp_str.decode('UTF-8')
-            split_str = re.split(' - ', tmp_str)
-            cell_type[split_str[0]] = split_str[1]
-        # - unit info
-        # print('Inserting spike unit: ', end = "")
-        for unit_str in tqdm.tqdm(ec_event_waveform.keys()):
-            unit_id = int(re.search('\d+', unit_str).group())
-            unit_depth = ec_unit_times.get(unit_str).get('depth').value
-            key['unit_id'] = unit_id
-            key['channel_id'] = ec_event_waveform.get(unit_str).get('electrode_idx').value.item(
-                0) - 1  # TODO: check if electrode_idx has MATLAB 1-based indexing (starts at 1)
-            key['spike_times'] = ec_unit_times.get(unit_str).get('times').value
-            key['unit_cell_type'] = cell_type[unit_str]
-            key.update(zip(('unit_x', 'unit_y', 'unit_z'), unit_depth))
-            key['spike_waveform'] = ec_event_waveform.get(unit_str).get('data').value
-            self.insert1(key)
-        #     print(f'{unit_id} ', end = "")
-        # print('')
-        nwb.close()
+        sess_data_file = os.path.join(sess_data_dir, sess_data_file)
+        with utilities.h5_file_pool.borrow(sess_data_file) as nwb:
+            # ------ Spike ------
+            ec_event_waveform = nwb['processing']['extracellular_units']['EventWaveform']
+            ec_unit_times = nwb['processing']['extracellular_units']['UnitTimes']
+            # - unit cell type
+            cell_type = get_unit_cell_types(sess_data_file)
+            # - unit info
+            rows = (dict(key,
+                         unit_id=int(re.search('\d+', unit_str).group()),
+                         channel_id=ec_event_waveform.get(unit_str).get('electrode_idx').value.item(
+                             0) - 1,  # TODO: check if electrode_idx has MATLAB 1-based indexing (starts at 1)
+                         spike_times=ec_unit_times.get(unit_str).get('times').value,
+                         unit_cell_type=cell_type[unit_str],
+                         spike_waveform=ec_event_waveform.get(unit_str).get('data').value,
+                         **dict(zip(('unit_x', 'unit_y', 'unit_z'), ec_unit_times.get(unit_str).get('depth').value)))
+                    for unit_str in tqdm.tqdm(ec_event_waveform.keys()))
+            # - insert all units in one transaction, in batches bounded by the "insert_batch_bytes" budget
+            with utilities.transaction(self.connection):
+                for batch in utilities.batched_by_bytes(rows):
+                    self.insert(batch)
+
+
+@schema
+class UnitWaveformSummary(dj.Computed):
+    definition = """  # summary of the spike waveforms of each unit, to be used instead of the raw waveforms
+    -> UnitSpikeTimes
+    ---
+    waveform_mean: longblob         # mean waveform across all spikes (waveform_timestamps)
+    waveform_sd: longblob           # standard deviation of the waveform across all spikes (waveform_timestamps)
+    waveform_amplitude: float       # peak-to-peak amplitude of the mean waveform
+    peak_to_trough_width: smallint  # (sample) from the trough of the mean waveform to its following peak
+    spike_count: int                # number of spikes (waveforms)
+    """
+
+    # summarize all units of a probe insertion at once
+    key_source = ProbeInsertion & UnitSpikeTimes
+
+    def make(self, key):
+        # fetch the raw waveforms one unit at a time, only the summaries are held in memory
+        self.insert(dict(unit_key, **summarize_waveforms((UnitSpikeTimes & unit_key).fetch1('spike_waveform')))
+                    for unit_key in (UnitSpikeTimes & key).fetch('KEY'))
+
+
+@schema
+class SphericalRegion(dj.Lookup):
+    definition = """  # spherical brain region, in which units are classified by their distance to the region center
+    region_name: varchar(32)
+    ---
+    region_center_x: double  # (mm)
+    region_center_y: double  # (mm)
+    region_center_z: double  # (mm)
+    region_radius: double    # (mm)
+    """
+    contents = [['VM/VAL', 0.95, -4.33, -1.5, 0.4]]  # ventral-medial/ventral-anterior-lateral of the thalamus
+
+
+@schema
+class UnitSphericalRegion(dj.Computed):
+    definition = """  # distance of each unit to the center of a spherical region
+    -> UnitSpikeTimes
+    -> SphericalRegion
+    ---
+    distance_to_center: float  # (mm)
+    in_region: bool
+    """
+
+    # classify all units of a probe insertion at once
+    key_source = (ProbeInsertion & UnitSpikeTimes) * SphericalRegion
+
+    def make(self, key):
+        unit_keys, distances, in_region = classify_units(UnitSpikeTimes & key, key['region_name'])
+        self.insert(dict(k, region_name=key['region_name'], distance_to_center=d, in_region=r)
+                    for k, d, r in zip(unit_keys, distances, in_region))
+
+    @classmethod
+    def populate_batch(cls, *restrictions):
+        # classify all units not yet classified, in one fetch and one insert per region
+        for region_name in (SphericalRegion & dj.AndList(restrictions)).fetch('region_name'):
+            units = (UnitSpikeTimes & cls.key_source & dj.AndList(restrictions)
+                     ) - (cls & {'region_name': region_name})
+            unit_keys, distances, in_region = classify_units(units, region_name)
+            cls.insert((dict(k, region_name=region_name, distance_to_center=d, in_region=r)
+                        for k, d, r in zip(unit_keys, distances, in_region)), allow_direct_insert=True)
 
 
 @schema
@@ -103,15 +161,21 @@ class VMVALUnit(dj.Computed):
     in_vmval: bool
     """
 
-    vm_center = (0.95, -4.33, -1.5)
-    dis_threshold = 0.4  # mm
+    region_name = 'VM/VAL'  # center and radius in SphericalRegion
 
-    key_source = UnitSpikeTimes & ProbeInsertion & 'brain_region = "Thalamus"'
+    # classify all thalamic units of a probe insertion at once
+    key_source = ProbeInsertion & UnitSpikeTimes & 'brain_region = "Thalamus"'
 
     def make(self, key):
-        uloc = (UnitSpikeTimes & key).fetch1('unit_x', 'unit_y', 'unit_z')
-        dist = np.linalg.norm(np.array(uloc) - np.array(self.vm_center))
-        self.insert1(dict(key, in_vmval=bool(dist <= self.dis_threshold)))
+        unit_keys, _, in_region = classify_units(UnitSpikeTimes & key, self.region_name)
+        self.insert(dict(k, in_vmval=r) for k, r in zip(unit_keys, in_region))
+
+    @classmethod
+    def populate_batch(cls, *restrictions):
+        # classify all thalamic units not yet classified, in one fetch and one insert
+        units = (UnitSpikeTimes & cls.key_source & dj.AndList(restrictions)) - cls
+        unit_keys, _, in_region = classify_units(units, cls.region_name)
+        cls.insert((dict(k, in_vmval=r) for k, r in zip(unit_keys, in_region)), allow_direct_insert=True)
 
 
 @schema
@@ -124,33 +188,160 @@ class TrialSegmentedUnitSpikeTimes(dj.Computed):
     segmented_spike_times: longblob
     """
 
+    # segment all trials of a unit at once, for each setting
+    key_source = (UnitSpikeTimes * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
     def make(self, key):
-        # get event, pre/post stim duration
-        event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
-            'event', 'pre_stim_duration', 'post_stim_duration')
-        # get event time
-        try:
-            event_time_point = analysis.get_event_time(event_name, key)
-        except analysis.EventChoiceError as e:
-            print(f'Trial segmentation error - Msg: {str(e)}')
-            return
+        # get raw & segment all trials
+        trial_ids, segmented_spike_times, trial_offsets = get_segmented_spike_times(key)
 
-        pre_stim_dur = float(pre_stim_dur)
-        post_stim_dur = float(post_stim_dur)
-        # check if pre/post stim dur is within start/stop time
-        trial_start, trial_stop = (acquisition.TrialSet.Trial & key).fetch1('start_time', 'stop_time')
-        if event_time_point - pre_stim_dur < trial_start:
-            print('Warning: Out of bound prestimulus duration, set to 0')
-            pre_stim_dur = 0
-        if event_time_point + post_stim_dur > trial_stop:
-            print('Warning: Out of bound poststimulus duration, set to trial end time')
-            post_stim_dur = trial_stop - event_time_point
-
-        # get raw & segment
+        rows = (dict(key, trial_id=trial_id, segmented_spike_times=segmented)
+                for trial_id, segmented in zip(trial_ids, split_trials(segmented_spike_times, trial_offsets)))
+        for batch in utilities.batched_by_bytes(rows):
+            self.insert(batch)
+        print(f'Perform trial-segmentation of spike times for unit: {key["unit_id"]} and {len(trial_ids)} trials')
+
+
+@schema
+class TrialSegmentedUnitSpikeRaster(dj.Computed):
+    definition = """ # trial-segmented spike times of all trials of a unit, stored as one flat array with per-trial offsets
+    -> UnitSpikeTimes
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob                 # (trial) id of each segmented trial
+    trial_offsets: longblob             # (trial + 1) start index of each trial in segmented_spike_times, last one is its length
+    segmented_spike_times: longblob     # (s) spike times of all trials, with respect to the event time of each trial
+    """
+
+    key_source = (UnitSpikeTimes * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
+    def make(self, key):
+        # get raw & segment all trials
+        trial_ids, segmented_spike_times, trial_offsets = get_segmented_spike_times(key)
+        self.insert1(dict(key, trial_ids=trial_ids, trial_offsets=trial_offsets,
+                          segmented_spike_times=segmented_spike_times))
+        print(f'Perform trial-segmentation of spike times for unit: {key["unit_id"]} and {len(trial_ids)} trials')
+
+    @classmethod
+    def fetch_trials(cls, key):
+        # trial ids and per-trial (zero-copy) views of the segmented spike times of one unit and setting
+        trial_ids, trial_offsets, segmented_spike_times = (cls & key).fetch1(
+            'trial_ids', 'trial_offsets', 'segmented_spike_times')
+        return trial_ids, split_trials(segmented_spike_times, trial_offsets)
+
+
+def summarize_waveforms(spike_waveform):
+    # mean and SD across spikes of the (spike x sample) "spike_waveform", and the features of the mean waveform
+    spike_waveform = np.atleast_2d(spike_waveform)
+    waveform_mean = np.mean(spike_waveform, axis=0)
+    trough = np.argmin(waveform_mean)
+    return dict(waveform_mean=waveform_mean,
+                waveform_sd=np.std(spike_waveform, axis=0),
+                waveform_amplitude=float(np.ptp(waveform_mean)),
+                peak_to_trough_width=int(np.argmax(waveform_mean[trough:])),
+                spike_count=spike_waveform.shape[0])
+
+
+def classify_units(units, region_name):
+    # distance of all "units" to the center of a spherical region, and whether within its radius - computed at once
+    center_x, center_y, center_z, radius = (SphericalRegion & {'region_name': region_name}).fetch1(
+        'region_center_x', 'region_center_y', 'region_center_z', 'region_radius')
+    unit_keys, unit_x, unit_y, unit_z = units.fetch('KEY', 'unit_x', 'unit_y', 'unit_z')
+    distances = np.linalg.norm(np.column_stack((unit_x, unit_y, unit_z)).astype(float)
+                               - np.array([center_x, center_y, center_z]), axis=1)
+    return unit_keys, distances, [bool(d <= radius) for d in distances]
+
+
+def get_segmented_spike_times(key):
+    # trial ids, flat segmented spike times and trial offsets of the unit and trial-segmentation setting in "key"
+    # when other settings share this event, the spike train is segmented once at their widest window (cached),
+    # and the segmentation of this setting is selected from it
+    event_name, pre_stim_dur, post_stim_dur, widest_pre_stim_dur, widest_post_stim_dur, is_shared = \
+        analysis.get_superset_window(key)
+
+    if not is_shared:
+        trial_ids, event_times, trial_starts, trial_stops = analysis.get_trials_event_time(event_name, key)
         spike_times = (UnitSpikeTimes & key).fetch1('spike_times')
-        key['segmented_spike_times'] = spike_times[np.logical_and(
-            (spike_times >= (event_time_point - pre_stim_dur)),
-            (spike_times <= (event_time_point + post_stim_dur)))] - event_time_point
+        return (trial_ids, *segment_spike_times(spike_times, event_times, trial_starts, trial_stops,
+                                                pre_stim_dur, post_stim_dur))
+
+    def segment_widest():
+        trial_ids, event_times, trial_starts, trial_stops = analysis.get_trials_event_time(event_name, key)
+        spike_times = (UnitSpikeTimes & key).fetch1('spike_times')
+        # not bounded by the trial start/stop time here, but when selected for each setting
+        unbounded = np.full(len(trial_ids), np.inf)
+        segmented_spike_times, trial_offsets = segment_spike_times(spike_times, event_times, -unbounded, unbounded,
+                                                                   widest_pre_stim_dur, widest_post_stim_dur)
+        return ((trial_ids, event_times, trial_starts, trial_stops, segmented_spike_times, trial_offsets),
+                segmented_spike_times.nbytes + trial_offsets.nbytes)
+
+    trial_ids, event_times, trial_starts, trial_stops, segmented_spike_times, trial_offsets = \
+        analysis.segmentation_cache.get((analysis.get_source_id(UnitSpikeTimes, key), event_name,
+                                         widest_pre_stim_dur, widest_post_stim_dur, key.get('trial_id')),
+                                        segment_widest)
+    return (trial_ids, *select_spike_times(segmented_spike_times, trial_offsets, event_times, trial_starts, trial_stops,
+                                           pre_stim_dur, post_stim_dur))
+
+
+def segment_spike_times(spike_times, event_times, trial_starts, trial_stops, pre_stim_dur, post_stim_dur):
+    # segment a spike train around the event time of each trial, relative to the event time
+    # out of bound prestimulus duration is set to 0, out of bound poststimulus duration is set to trial end time
+    # return the segmented spike times of all trials as one flat array, and the offset of each trial in it (CSR style)
+    spike_times = np.asarray(spike_times, dtype=float).ravel()
+    if np.any(np.diff(spike_times) < 0):
+        spike_times = np.sort(spike_times)
+    pre_out_of_bound, post_out_of_bound = check_out_of_bound(event_times, trial_starts, trial_stops,
+                                                             pre_stim_dur, post_stim_dur)
+    seg_starts = np.where(pre_out_of_bound, event_times, event_times - pre_stim_dur)
+    seg_stops = np.where(post_out_of_bound, trial_stops, event_times + post_stim_dur)
+    # spikes in [seg_start, seg_stop] of each trial, as index ranges of the sorted spike train
+    seg_start_idx = np.searchsorted(spike_times, seg_starts, side='left')
+    seg_lengths = np.maximum(np.searchsorted(spike_times, seg_stops, side='right') - seg_start_idx, 0)
+    trial_offsets = np.concatenate(([0], np.cumsum(seg_lengths))).astype(np.int64)
+    spike_idx = np.arange(trial_offsets[-1]) + np.repeat(seg_start_idx - trial_offsets[:-1], seg_lengths)
+    segmented_spike_times = spike_times[spike_idx] - np.repeat(event_times, seg_lengths)
+    return segmented_spike_times, trial_offsets
+
+
+def select_spike_times(segmented_spike_times, trial_offsets, event_times, trial_starts, trial_stops,
+                       pre_stim_dur, post_stim_dur):
+    # select the segmentation of a narrower window out of the (trial-unbounded) segmented spike times of a wider one
+    pre_out_of_bound, post_out_of_bound = check_out_of_bound(event_times, trial_starts, trial_stops,
+                                                             pre_stim_dur, post_stim_dur)
+    seg_starts = np.where(pre_out_of_bound, 0, -pre_stim_dur)
+    seg_stops = np.where(post_out_of_bound, trial_stops - event_times, post_stim_dur)
+    trial_idx = np.repeat(np.arange(len(event_times)), np.diff(trial_offsets))
+    is_selected = ((segmented_spike_times >= seg_starts[trial_idx])
+                   & (segmented_spike_times <= seg_stops[trial_idx]))
+    seg_lengths = np.bincount(trial_idx[is_selected], minlength=len(event_times))
+    return segmented_spike_times[is_selected], np.concatenate(([0], np.cumsum(seg_lengths))).astype(np.int64)
+
+
+def check_out_of_bound(event_times, trial_starts, trial_stops, pre_stim_dur, post_stim_dur):
+    # trials of which the pre/post stim duration is out of the trial start/stop time
+    pre_out_of_bound = event_times - pre_stim_dur < trial_starts
+    post_out_of_bound = event_times + post_stim_dur > trial_stops
+    if pre_out_of_bound.any() or post_out_of_bound.any():
+        print(f'Warning: Out of bound prestimulus duration for {np.sum(pre_out_of_bound)} trial(s), set to 0 - '
+              f'out of bound poststimulus duration for {np.sum(post_out_of_bound)} trial(s), set to trial end time')
+    return pre_out_of_bound, post_out_of_bound
+
+
+def split_trials(segmented_spike_times, trial_offsets):
+    # per-trial (zero-copy) views of the flat segmented spike times
+    if len(trial_offsets) < 2:
+        return []
+    return np.split(segmented_spike_times, trial_offsets[1:-1])
+
+
+def get_unit_cell_types(sess_data_file):
+    # unit name -> cell type, parsed once per version (size and mtime) of the file
+    st = os.stat(sess_data_file)
+    return _read_unit_cell_types(os.path.abspath(sess_data_file), st.st_size, st.st_mtime_ns)
+
 
-        self.insert1(key)
-        print(f'Perform trial-segmentation of spike times for unit: {key["unit_id"]} and trial: {key["trial_id"]}')
+@functools.lru_cache(maxsize=16)
+def _read_unit_cell_types(sess_data_file, file_size, file_mtime):
+    with utilities.h5_file_pool.borrow(sess_data_file) as nwb:
+        cell_types = nwb['processing']['extracellular_units']['UnitTimes'].get('cell_types').value
+    return dict(re.split(' - ', s.decode('UTF-8'))[:2] for s in cell_types)
@@ -0,0 +1,194 @@
+'''
+Parallel, incremental ingestion of the NWB data files into the pipeline.
+Every ingested file is recorded in acquisition.SourceFile, unchanged files are skipped on reruns without being opened.
+'''
+import os
+import re
+import time
+import traceback
+from decimal import Decimal
+import datajoint as dj
+
+from . import acquisition, utilities
+
+
+class AliasMatcher:
+    '''
+    Case-insensitive matcher of the aliases of a lookup table, compiled once: alias -> value
+    '''
+    def __init__(self, aliases):
+        self.aliases = {alias.lower(): value for alias, value in aliases}
+        self.regex = re.compile('|'.join(re.escape(alias) for alias in self.aliases), re.I)
+
+    def findall(self, s):
+        return [self.aliases[m.lower()] for m in self.regex.findall(s)]
+
+    def search(self, s, default='N/A'):
+        m = self.regex.search(s)
+        return self.aliases[m.group().lower()] if m else default
+
+
+class IngestContext:
+    '''
+    In-memory primary-key sets of the tables checked by an ingest script, and its alias matchers
+    Loaded once per process on first use - membership checks are then local, inserts update the key sets
+    A key inserted meanwhile by another process is just inserted again with "skip_duplicates"
+    '''
+    def __init__(self, *tables, aliases=None):
+        self.tables = [t() if isinstance(t, type) else t for t in tables]
+        self.alias_tables = aliases or {}  # name -> (table, alias attribute, value attribute)
+        self._pid = None
+
+    def load(self):
+        self.keys = {}
+        for table in self.tables:
+            self.keys[table.full_table_name] = {self._key(table, k) for k in table.fetch('KEY')}
+        self.matchers = {name: AliasMatcher(zip(*table.fetch(alias_attr, value_attr)))
+                         for name, (table, alias_attr, value_attr) in self.alias_tables.items()}
+        self._pid = os.getpid()
+
+    def _check_loaded(self):
+        # (re)load in each process, e.g. a worker forked from a process having loaded it
+        if self._pid != os.getpid():
+            self.load()
+
+    @staticmethod
+    def _key(table, row):
+        # decimal attributes compare as floats, whether fetched or computed by the ingest script
+        return tuple(float(row[k]) if isinstance(row[k], Decimal) else row[k] for k in table.primary_key)
+
+    def _keyset(self, table):
+        self._check_loaded()
+        return self.keys[table.full_table_name]
+
+    def exists(self, table, row):
+        return self._key(table, row) in self._keyset(table)
+
+    def add(self, table, row):
+        # record "row" as inserted in "table", e.g. by a master-part insert of the caller
+        self._keyset(table).add(self._key(table, row))
+
+    def insert1(self, table, row, **kwargs):
+        # insert "row" in "table" unless already there, return True if inserted
+        if self.exists(table, row):
+            return False
+        table.insert1(row, skip_duplicates=True, **kwargs)
+        self.add(table, row)
+        return True
+
+    def insert(self, table, rows, **kwargs):
+        rows = [r for r in rows if not self.exists(table, r)]
+        if rows:
+            table.insert(rows, skip_duplicates=True, **kwargs)
+            for r in rows:
+                self.add(table, r)
+
+    def matcher(self, name):
+        self._check_loaded()
+        return self.matchers[name]
+
+
+def _file_signature(filepath):
+    st = os.stat(filepath)
+    return dict(file_size=st.st_size, file_mtime=st.st_mtime, file_hash=utilities.file_sha1(filepath))
+
+
+def _hash_file(args):
+    data_dir, fname = args
+    try:
+        return fname, _file_signature(os.path.join(data_dir, fname)), None
+    except Exception as e:
+        return fname, None, f'{type(e).__name__}: {str(e)}'
+
+
+def _ingest_file(args):
+    ingest_file, data_dir, fname = args
+    start = time.time()
+    try:
+        # signature taken before ingesting, a file modified in-between is then seen as changed on the next run
+        signature = _file_signature(os.path.join(data_dir, fname))
+        session_key = ingest_file(fname)
+    except Exception as e:
+        traceback.print_exc()
+        return fname, f'{type(e).__name__}: {str(e)}', time.time() - start, None, None
+    return fname, None, time.time() - start, session_key, signature
+
+
+def check_manifest(data_dir, which_data, fnames, processes=1):
+    '''
+    Compare "fnames" of "data_dir" against acquisition.SourceFile
+    Return (new, unchanged, changed) lists of filenames
+     + unchanged: same size and mtime as recorded, not opened - or same content hash (e.g. touched or copied files)
+     + changed: content hash differs from the ingested file, flagged as "changed" in the manifest
+    '''
+    manifest = {r['file_name']: r for r in (acquisition.SourceFile & {'data_type': which_data}).fetch(as_dict=True)}
+
+    new, unchanged, changed, to_hash = [], [], [], []
+    for fname in fnames:
+        entry = manifest.get(fname)
+        if entry is None:
+            new.append(fname)
+            continue
+        st = os.stat(os.path.join(data_dir, fname))
+        if (st.st_size, st.st_mtime) == (entry['file_size'], entry['file_mtime']):
+            (changed if entry['ingest_status'] == 'changed' else unchanged).append(fname)
+        else:
+            to_hash.append(fname)
+
+    for fname, signature, error in utilities.parallel_map(
+            _hash_file, [(data_dir, f) for f in to_hash], processes=processes):
+        if error is not None:
+            print(f'!!! ERROR HASHING FILE: {fname} - {error}')
+            continue
+        entry = manifest[fname]
+        if signature['file_hash'] != entry['file_hash']:
+            entry['ingest_status'] = 'changed'
+        (changed if entry['ingest_status'] == 'changed' else unchanged).append(fname)
+        acquisition.SourceFile.insert1({**entry, **signature}, replace=True)
+
+    return new, unchanged, changed
+
+
+def ingest_files(ingest_file, data_dir, which_data, fnames=None, processes=None):
+    '''
+    Call "ingest_file(fname)" for each new file of "data_dir" (all files if "fnames" is None) over a pool of
+    "processes" worker processes (default: "ingest_processes" in dj.config['custom'], or 1) and print a summary
+    "ingest_file" returns the session key of the file, recorded along with the file in acquisition.SourceFile
+    Files whose content changed since they were ingested are flagged and reported, not re-ingested - to re-ingest,
+    delete their session (which also deletes their manifest entry) and rerun
+    '''
+    processes = processes or dj.config['custom'].get('ingest_processes', 1)
+    if fnames is None:  # hidden files, e.g. the session index, are not data files
+        fnames = sorted(f for f in os.listdir(data_dir) if not f.startswith('.'))
+    fnames = list(fnames)
+
+    start = time.time()
+    new, unchanged, changed = check_manifest(data_dir, which_data, fnames, processes=processes)
+    print(f'{len(fnames)} file(s): {len(new)} new, {len(unchanged)} unchanged, {len(changed)} changed '
+          f'({time.time() - start:.1f}s)')
+    print(f'Ingesting {len(new)} file(s) with {processes} worker(s)')
+
+    start = time.time()
+    failed = {}
+    for count, (fname, error, duration, session_key, signature) in enumerate(utilities.parallel_map(
+            _ingest_file, [(ingest_file, data_dir, f) for f in new], processes=processes,
+            initializer=utilities.reset_connection if processes > 1 else None), start=1):
+        if error is not None:
+            failed[fname] = error
+        else:
+            acquisition.SourceFile.insert1(dict(
+                signature, **(session_key or {}), data_type=which_data, file_name=fname,
+                ingest_status='ingested'), ignore_extra_fields=True)
+        print(f'[{count}/{len(new)}] {"FAILED" if error else "Done"}: {fname} ({duration:.1f}s)')
+
+    duration = time.time() - start
+    rate = len(new) / duration * 60 if duration > 0 else float('nan')
+    print('=================================')
+    print(f'Ingested {len(new) - len(failed)}/{len(new)} file(s) in {duration / 60:.1f} min '
+          f'({rate:.1f} files/min, {processes} worker(s))')
+    for fname, error in failed.items():
+        print(f'!!! FAILED: {fname} - {error}')
+    for fname in changed:
+        print(f'!!! CHANGED SINCE INGESTED, NEEDS RE-INGEST: {fname}')
+    print('=================================')
+    return failed
@@ -0,0 +1,231 @@
+'''
+Opt-in instrumentation of the make() of every imported/computed table of the pipeline.
+For each key, records the wall time split into fetch (of which blob decoding), insert (of which blob encoding) and
+compute (the rest), the blob bytes decoded and encoded, and the rows inserted - as JSON lines and/or, aggregated per
+table, as a Prometheus text file.
+
+    from pipeline import instrumentation
+    instrumentation.enable(jsonl_path='metrics.jsonl', prometheus_path='metrics_{pid}.prom')
+
+or set "instrumentation": {"jsonl_path": ..., "prometheus_path": ...} in dj.config['custom'] and call enable()
+'''
+import os
+import json
+import time
+import platform
+import threading
+import functools
+from collections import OrderedDict, defaultdict
+from collections.abc import Iterator
+from datetime import datetime
+import numpy as np
+import datajoint as dj
+
+
+phases = ('fetch', 'decode', 'insert', 'encode', 'compute')
+counters = ('bytes_in', 'bytes_out', 'rows')
+
+_patched = []  # (owner, attribute name, original)
+_current = []  # stack of the records of the make() calls in progress
+_totals = defaultdict(lambda: defaultdict(float))  # table -> aggregated metrics of the process "_totals_pid"
+_totals_pid = [os.getpid()]
+_output = {}
+_nesting = threading.local()  # the phases being timed, e.g. the fetch called by fetch1 is not timed again
+
+
+def _account(name, value):
+    if _current:
+        _current[-1][name] += value
+
+
+def _timed(phase, func):
+    # time the calls of "func" made within a make(), as "phase"
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _current or getattr(_nesting, phase, False):  # only the outermost call is timed
+            return func(*args, **kwargs)
+        setattr(_nesting, phase, True)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _account(phase, time.perf_counter() - start)
+            setattr(_nesting, phase, False)
+    return wrapper
+
+
+def _unpack(func):
+    @functools.wraps(func)
+    def wrapper(blob, *args, **kwargs):
+        _account('bytes_in', len(blob) if isinstance(blob, (bytes, bytearray, memoryview)) else 0)
+        return func(blob, *args, **kwargs)
+    return _timed('decode', wrapper)
+
+
+def _pack(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        packed = func(*args, **kwargs)
+        _account('bytes_out', len(packed) if isinstance(packed, (bytes, bytearray)) else 0)
+        return packed
+    return _timed('encode', wrapper)
+
+
+def _insert(func):
+    timed = _timed('insert', func)
+
+    @functools.wraps(func)
+    def wrapper(self, rows, *args, **kwargs):
+        if _current and not hasattr(rows, 'make_sql'):  # not counted: insert from a query
+            if isinstance(rows, Iterator):
+                # rows built lazily: their computation is accounted as compute, not insert
+                rows = list(rows)
+            _account('rows', len(rows))
+        return timed(self, rows, *args, **kwargs)
+    return wrapper
+
+
+def _make(table_name, func):
+    @functools.wraps(func)
+    def wrapper(self, key, *args, **kwargs):
+        record = OrderedDict(table=table_name, key=key, **{p: 0. for p in phases}, **{c: 0 for c in counters})
+        _current.append(record)
+        status, start = 'ok', time.perf_counter()
+        try:
+            return func(self, key, *args, **kwargs)
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            _current.pop()
+            record['wall'] = time.perf_counter() - start
+            record['compute'] = record['wall'] - record['fetch'] - record['insert']
+            record['status'] = status
+            _record(record)
+    return wrapper
+
+
+def _patch(owner, name, wrap):
+    if hasattr(owner, name):
+        original = getattr(owner, name)
+        _patched.append((owner, name, original))
+        setattr(owner, name, wrap(original))
+
+
+def get_tables():
+    # the imported/computed tables of the pipeline, by name (e.g. "extracellular.UnitSpikeTimes")
+    from . import acquisition, analysis, behavior, extracellular, intracellular, stimulation
+    tables = {}
+    for module in (acquisition, analysis, behavior, extracellular, intracellular, stimulation):
+        for name, obj in vars(module).items():
+            if (isinstance(obj, type) and issubclass(obj, (dj.Imported, dj.Computed))
+                    and obj.__module__ == module.__name__ and 'make' in vars(obj)):
+                tables[f'{module.__name__.split(".")[-1]}.{name}'] = obj
+    return tables
+
+
+def enable(jsonl_path=None, prometheus_path=None):
+    '''
+    Instrument the make() of all tables of the pipeline, and the fetch, insert and blob (de)serialization they call
+    "jsonl_path": file the record of each make() is appended to
+    "prometheus_path": Prometheus text file of the metrics aggregated per table, rewritten after each make(),
+     "{pid}" in the path is replaced by the process id (one file per worker process)
+    Defaults: "instrumentation" in dj.config['custom']
+    '''
+    if _patched:
+        return
+    config = dj.config['custom'].get('instrumentation', {})
+    _output.update(jsonl_path=jsonl_path or config.get('jsonl_path'),
+                   prometheus_path=prometheus_path or config.get('prometheus_path'))
+
+    for table_name, table in get_tables().items():
+        _patch(table, 'make', functools.partial(_make, table_name))
+    _patch(dj.fetch.Fetch, '__call__', functools.partial(_timed, 'fetch'))
+    _patch(dj.fetch.Fetch1, '__call__', functools.partial(_timed, 'fetch'))
+    _patch(dj.table.Table, 'insert', _insert)
+    # fetch and insert call the blob (de)serialization through the blob module
+    _patch(dj.blob, 'unpack', _unpack)
+    _patch(dj.blob, 'pack', _pack)
+
+
+def disable():
+    while _patched:
+        owner, name, original = _patched.pop()
+        setattr(owner, name, original)
+
+
+def _record(record):
+    # each (worker) process aggregates its own metrics - a forked process starts from none
+    if _totals_pid[0] != os.getpid():
+        _totals.clear()
+        _totals_pid[0] = os.getpid()
+    totals = _totals[record['table']]
+    totals['calls'] += 1
+    totals['errors'] += record['status'] == 'error'
+    for k in ('wall',) + phases + counters:
+        totals[k] += record[k]
+
+    if _output.get('jsonl_path'):
+        line = json.dumps(dict(record, time=datetime.now().isoformat(), host=platform.node(), pid=os.getpid()),
+                          default=str)
+        with open(_output['jsonl_path'], 'a') as f:
+            f.write(line + '\n')
+    if _output.get('prometheus_path'):
+        write_prometheus(_output['prometheus_path'].format(pid=os.getpid()))
+
+
+def write_prometheus(path):
+    # metrics of this process aggregated per table, in the Prometheus text format - written atomically
+    families = OrderedDict((name, []) for name in (
+        'pipeline_make_calls_total', 'pipeline_make_errors_total', 'pipeline_make_seconds_total',
+        'pipeline_blob_bytes_total', 'pipeline_rows_inserted_total'))
+    for table, totals in sorted(_totals.items()):
+        label = f'table="{table}"'
+        families['pipeline_make_calls_total'].append(f'{{{label}}} {totals["calls"]:g}')
+        families['pipeline_make_errors_total'].append(f'{{{label}}} {totals["errors"]:g}')
+        for phase in ('wall',) + phases:
+            families['pipeline_make_seconds_total'].append(f'{{{label},phase="{phase}"}} {totals[phase]:.6f}')
+        families['pipeline_blob_bytes_total'].append(f'{{{label},direction="in"}} {totals["bytes_in"]:g}')
+        families['pipeline_blob_bytes_total'].append(f'{{{label},direction="out"}} {totals["bytes_out"]:g}')
+        families['pipeline_rows_inserted_total'].append(f'{{{label}}} {totals["rows"]:g}')
+    lines = []
+    for name, samples in families.items():
+        lines.append(f'# TYPE {name} counter')
+        lines.extend(name + sample for sample in samples)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+def load_records(*jsonl_paths):
+    records = []
+    for path in jsonl_paths:
+        with open(path, 'r') as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
+
+
+def report(*jsonl_paths, top=5):
+    # summary per table of the records in "jsonl_paths": time per phase, bytes and rows, and the slowest keys
+    records = load_records(*jsonl_paths)
+    by_table = defaultdict(list)
+    for r in records:
+        by_table[r['table']].append(r)
+
+    print(f'{len(records)} make() call(s) of {len(by_table)} table(s)')
+    for table, rs in sorted(by_table.items(), key=lambda x: -sum(r['wall'] for r in x[1])):
+        wall = np.array([r['wall'] for r in rs])
+        total = {k: sum(r[k] for r in rs) for k in phases + counters}
+        n_errors = sum(r['status'] == 'error' for r in rs)
+        print('=================================')
+        print(f'{table}: {len(rs)} call(s){f" ({n_errors} error(s))" if n_errors else ""} - '
+              f'total {wall.sum():.1f}s, mean {wall.mean():.2f}s, median {np.median(wall):.2f}s, max {wall.max():.2f}s')
+        print('\t' + ', '.join(f'{p} {total[p]:.1f}s ({total[p] / wall.sum():.0%})' if wall.sum() > 0
+                               else f'{p} {total[p]:.1f}s' for p in phases)
+              + '  [decode within fetch, encode within insert]')
+        print(f'\tblob in {total["bytes_in"] / 1024 ** 2:.1f} MB, blob out {total["bytes_out"] / 1024 ** 2:.1f} MB, '
+              f'rows inserted {total["rows"]:g}')
+        for r in sorted(rs, key=lambda r: -r['wall'])[:top]:
+            print(f'\t{r["wall"]:.2f}s (fetch {r["fetch"]:.2f}s, compute {r["compute"]:.2f}s, '
+                  f'insert {r["insert"]:.2f}s) - {r["key"]}')
@@ -6,7 +6,6 @@ import os
 import pathlib
 import numpy as np
 import datajoint as dj
-import h5py as h5
 
 from . import reference, utilities, acquisition, analysis
 
@@ -47,23 +46,22 @@ class MembranePotential(dj.Imported):
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
             raise FileNotFoundError(f'IntracellularAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
         #  ============= Now read the data and start ingesting =============
         print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
                                                                                            key['session_time'],
                                                                                            key['cell_id']))
-        # -- MembranePotential
-        membrane_potential_time_stamps = nwb['acquisition']['timeseries']['membrane_potential']['timestamps'].value
-        self.insert1(dict(key,
-                          membrane_potential=nwb['acquisition']['timeseries']['membrane_potential'][
-                              'data'].value,
-                          membrane_potential_wo_spike=
-                          nwb['analysis']['Vm_wo_spikes']['membrane_potential_wo_spike'][
-                              'data'].value,
-                          membrane_potential_start_time=membrane_potential_time_stamps[0],
-                          membrane_potential_sampling_rate=1 / np.mean(
-                              np.diff(membrane_potential_time_stamps))))
-        nwb.close()
+        with utilities.h5_file_pool.borrow(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            # -- MembranePotential
+            membrane_potential_time_stamps = nwb['acquisition']['timeseries']['membrane_potential']['timestamps'].value
+            self.insert1(dict(key,
+                              membrane_potential=nwb['acquisition']['timeseries']['membrane_potential'][
+                                  'data'].value,
+                              membrane_potential_wo_spike=
+                              nwb['analysis']['Vm_wo_spikes']['membrane_potential_wo_spike'][
+                                  'data'].value,
+                              membrane_potential_start_time=membrane_potential_time_stamps[0],
+                              membrane_potential_sampling_rate=1 / np.mean(
+                                  np.diff(membrane_potential_time_stamps))))
 
 
 @schema
@@ -85,20 +83,19 @@ class CurrentInjection(dj.Imported):
         sess_data_file = utilities.find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment)
         if sess_data_file is None:
             raise FileNotFoundError(f'IntracellularAcquisition import failed for: {animal_id} - {date_of_experiment}')
-        nwb = h5.File(os.path.join(sess_data_dir, sess_data_file), 'r')
         #  ============= Now read the data and start ingesting =============
         print('Insert intracellular data for: subject: {0} - date: {1} - cell: {2}'.format(key['subject_id'],
                                                                                            key['session_time'],
                                                                                            key['cell_id']))
-        # -- CurrentInjection
-        current_injection_time_stamps = nwb['acquisition']['timeseries']['current_injection']['timestamps'].value
-        self.insert1(dict(key,
-                                           current_injection = nwb['acquisition']['timeseries']['current_injection'][
-                                               'data'].value,
-                                           current_injection_start_time = current_injection_time_stamps[0],
-                                           current_injection_sampling_rate = 1 / np.mean(
-                                               np.diff(current_injection_time_stamps))))
-        nwb.close()
+        with utilities.h5_file_pool.borrow(os.path.join(sess_data_dir, sess_data_file)) as nwb:
+            # -- CurrentInjection
+            current_injection_time_stamps = nwb['acquisition']['timeseries']['current_injection']['timestamps'].value
+            self.insert1(dict(key,
+                                               current_injection = nwb['acquisition']['timeseries']['current_injection'][
+                                                   'data'].value,
+                                               current_injection_start_time = current_injection_time_stamps[0],
+                                               current_injection_sampling_rate = 1 / np.mean(
+                                                   np.diff(current_injection_time_stamps))))
 
 
 @schema
@@ -112,23 +109,55 @@ class TrialSegmentedMembranePotential(dj.Computed):
     segmented_mp_wo_spike: longblob
     """
 
+    # segment all trials of a cell at once, for each setting
+    key_source = (MembranePotential * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
+    def make(self, key):
+        # get raw - fetched once for all trials
+        fs, first_time_point, Vm_wo_spike, Vm_w_spike = (MembranePotential & key).fetch1(
+            'membrane_potential_sampling_rate', 'membrane_potential_start_time', 'membrane_potential_wo_spike',
+            'membrane_potential')
+        # segmentation & insert, in chunks of trials bounded by the "insert_batch_bytes" memory budget
+        trial_count = 0
+        for trial_ids, (segmented_Vm_w_spike, segmented_Vm_wo_spike) in analysis.perform_session_trial_segmentation(
+                key, fs, first_time_point, (Vm_w_spike, Vm_wo_spike),
+                source=analysis.get_source_id(MembranePotential, key)):
+            self.insert(dict(key,
+                             trial_id=trial_id,
+                             segmented_mp=segmented_Vm_w_spike[idx],
+                             segmented_mp_wo_spike=segmented_Vm_wo_spike[idx])
+                        for idx, trial_id in enumerate(trial_ids))
+            trial_count += len(trial_ids)
+        print(f'Perform trial-segmentation of membrane potential for cell: {key["cell_id"]} and {trial_count} trials')
+
+
+@schema
+class TrialSegmentedMembranePotentialMatrix(dj.Computed):
+    definition = """ # membrane potential of all trials of a cell, segmented into one (trial x sample) matrix
+    -> MembranePotential
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob                 # (trial) id of the trial of each row
+    segmented_mp: longblob              # (mV) (trial x sample), NaN where out of the trial
+    segmented_mp_wo_spike: longblob     # (mV) (trial x sample), NaN where out of the trial
+    """
+
+    key_source = (MembranePotential * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
     def make(self, key):
-        # get event, pre/post stim duration
-        event_name, pre_stim_dur, post_stim_dur = (analysis.TrialSegmentationSetting & key).fetch1(
-            'event', 'pre_stim_duration', 'post_stim_duration')
         # get raw
         fs, first_time_point, Vm_wo_spike, Vm_w_spike = (MembranePotential & key).fetch1(
             'membrane_potential_sampling_rate', 'membrane_potential_start_time', 'membrane_potential_wo_spike',
             'membrane_potential')
         # segmentation
-        segmented_Vm_wo_spike = analysis.perform_trial_segmentation(key, event_name, pre_stim_dur, post_stim_dur,
-                                                           Vm_wo_spike, fs, first_time_point)
-        segmented_Vm_w_spike = analysis.perform_trial_segmentation(key, event_name, pre_stim_dur, post_stim_dur,
-                                                          Vm_w_spike, fs, first_time_point)
+        (trial_ids, (segmented_Vm_w_spike, segmented_Vm_wo_spike)), = analysis.perform_session_trial_segmentation(
+            key, fs, first_time_point, (Vm_w_spike, Vm_wo_spike), max_bytes=np.inf,
+            source=analysis.get_source_id(MembranePotential, key))
         self.insert1(dict(key,
-                          segmented_mp = segmented_Vm_w_spike,
-                          segmented_mp_wo_spike = segmented_Vm_wo_spike))
-        print(f'Perform trial-segmentation of membrane potential for trial: {key["trial_id"]}')
+                          trial_ids=trial_ids,
+                          segmented_mp=segmented_Vm_w_spike,
+                          segmented_mp_wo_spike=segmented_Vm_wo_spike))
+        print(f'Perform trial-segmentation of membrane potential for cell: {key["cell_id"]} and {len(trial_ids)} trials')
 
 
 @schema
@@ -152,3 +181,27 @@ class TrialSegmentedCurrentInjection(dj.Computed):
                                                                  current_injection, fs, first_time_point)
         self.insert1(dict(key, segmented_current_injection = segmented_current_injection))
         print(f'Perform trial-segmentation of current injection for trial: {key["trial_id"]}')
+
+
+@schema
+class TrialSegmentedCurrentInjectionMatrix(dj.Computed):
+    definition = """ # current injection of all trials of a cell, segmented into one (trial x sample) matrix
+    -> CurrentInjection
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob                     # (trial) id of the trial of each row
+    segmented_current_injection: longblob   # (trial x sample), NaN where out of the trial
+    """
+
+    key_source = (CurrentInjection * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
+    def make(self, key):
+        # get raw
+        fs, first_time_point, current_injection = (CurrentInjection & key).fetch1(
+            'current_injection_sampling_rate', 'current_injection_start_time', 'current_injection')
+        # segmentation
+        (trial_ids, (segmented_current_injection,)), = analysis.perform_session_trial_segmentation(
+            key, fs, first_time_point, (current_injection,), max_bytes=np.inf,
+            source=analysis.get_source_id(CurrentInjection, key))
+        self.insert1(dict(key, trial_ids=trial_ids, segmented_current_injection=segmented_current_injection))
+        print(f'Perform trial-segmentation of current injection for cell: {key["cell_id"]} and {len(trial_ids)} trials')
@@ -0,0 +1,186 @@
+'''
+Launcher of local populate workers sharing the keys through the job reservation tables ("~jobs" of each schema).
+Each worker refreshes the timestamp of its reservations (heartbeat), so the reservations left by dead workers,
+of this or of any earlier run, can be told apart and reclaimed after a timeout.
+'''
+import os
+import time
+import signal
+import platform
+import threading
+import multiprocessing as mp
+import datajoint as dj
+
+from . import utilities, scheduler
+
+
+def get_jobs_tables(tables):
+    # the job reservation tables ("~jobs") of the schemas of "tables" - declared if not yet
+    connection = tables[0].connection
+    return [connection.schemas[database].jobs for database in sorted({table.database for table in tables})]
+
+
+class Heartbeat(threading.Thread):
+    '''
+    Refresh, every "interval" seconds, the timestamp of the jobs reserved by this process - on its own connection
+    '''
+    def __init__(self, jobs_tables, interval):
+        super().__init__(daemon=True)
+        self.jobs_table_names = [jobs_table.full_table_name for jobs_table in jobs_tables]
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        connection = dj.Connection(dj.config['database.host'], dj.config['database.user'],
+                                   dj.config['database.password'])
+        host, pid = platform.node(), os.getpid()
+        while not self.stopped.wait(self.interval):
+            for jobs_table_name in self.jobs_table_names:
+                connection.query(f'UPDATE {jobs_table_name} SET timestamp = CURRENT_TIMESTAMP '
+                                 f'WHERE status = "reserved" AND host = %s AND pid = %s', args=(host, pid))
+        connection.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _delete(jobs_tables, *restrictions):
+    # delete the jobs matching all "restrictions", return the number deleted
+    count = 0
+    for jobs_table in jobs_tables:
+        jobs = jobs_table
+        for restriction in restrictions:
+            jobs = jobs & restriction
+        count += len(jobs)
+        jobs.delete_quick()
+    return count
+
+
+def reclaim_stale_jobs(jobs_tables, timeout):
+    # release the reservations without heartbeat for more than "timeout" seconds, return the number released
+    return _delete(jobs_tables, {'status': 'reserved'}, f'timestamp < NOW() - INTERVAL {int(timeout)} SECOND')
+
+
+def release_worker_jobs(jobs_tables, pid):
+    # release the reservations of a worker of this host - and its keys interrupted by SIGTERM
+    # (recorded as errors by populate)
+    return _delete(jobs_tables, {'host': platform.node(), 'pid': pid},
+                   [{'status': 'reserved'}, 'status = "error" AND LEFT(error_message, 10) = "SystemExit"'])
+
+
+def count_reserved_jobs(jobs_tables):
+    # number of keys being populated, by the workers of this or of any other host
+    return sum(len(jobs_table & {'status': 'reserved'}) for jobs_table in jobs_tables)
+
+
+def _raise_system_exit(signum, frame):
+    raise SystemExit('SIGTERM received')
+
+
+def _worker(tables, stop, heartbeat_interval, poll_interval, batch_size, settings):
+    # Ctrl-C is handled by the launcher, which asks the workers to stop - SIGTERM terminates the worker with a
+    # SystemExit, as within populate(reserve_jobs=True), so its reservations are released below on every path
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _raise_system_exit)
+    utilities.reset_connection()
+    jobs_tables = get_jobs_tables(tables)
+    heartbeat = Heartbeat(jobs_tables, heartbeat_interval)
+    heartbeat.start()
+    try:
+        # passes over all tables until one completes no key while no key is reserved: keys reserved by the other
+        # workers may be released (or, once completed, make downstream keys ready) - the worker completing the
+        # last key makes the final pass
+        while not stop.is_set():
+            progress = False
+            for table in tables:
+                # populate in batches of "batch_size" keys, checking for a stop request in-between,
+                # until a batch completes no key
+                while not stop.is_set():
+                    count = len(table())
+                    errors = table.populate(max_calls=batch_size, **settings)
+                    if not errors and len(table()) == count:
+                        break
+                    progress = True
+            if not progress:
+                if not count_reserved_jobs(jobs_tables):
+                    return
+                stop.wait(poll_interval)
+    finally:
+        heartbeat.stop()
+        release_worker_jobs(jobs_tables, os.getpid())
+
+
+def launch_workers(tables, n_workers=None, heartbeat_interval=None, stale_timeout=None, shutdown_timeout=None,
+                   batch_size=None, poll_interval=None, settings=None):
+    '''
+    Start and supervise "n_workers" local worker processes (default: the number of cores), each populating
+    "tables" upstream first, in batches of "batch_size" keys - until no key is left and no key is reserved,
+    re-checking every "poll_interval" seconds while other workers hold the reservations
+    Reservations without heartbeat (every "heartbeat_interval" seconds) for "stale_timeout" seconds are reclaimed,
+    a crashed worker has its reservations released and is replaced
+    On SIGTERM (or Ctrl-C), the workers stop after their current batch - after "shutdown_timeout" seconds, or on
+    a second signal, they are terminated
+    Defaults: "launcher_*" in dj.config['custom']
+    '''
+    config = dj.config['custom']
+    n_workers = n_workers or config.get('launcher_workers') or mp.cpu_count()
+    heartbeat_interval = heartbeat_interval or config.get('launcher_heartbeat_interval', 30)
+    stale_timeout = stale_timeout or config.get('launcher_stale_timeout', 10 * heartbeat_interval)
+    shutdown_timeout = shutdown_timeout or config.get('launcher_shutdown_timeout', 600)
+    batch_size = batch_size or config.get('launcher_batch_size', 10)
+    poll_interval = poll_interval or config.get('launcher_poll_interval', 10)
+    settings = {**scheduler.default_settings, 'order': 'random', **(settings or {}), 'reserve_jobs': True}
+
+    tables = scheduler.topological_order(scheduler.get_upstream(tables))
+    jobs_tables = get_jobs_tables(tables)
+    print(f'Reclaimed {reclaim_stale_jobs(jobs_tables, stale_timeout)} stale reservation(s)')
+
+    stop = mp.Event()
+    stop_requested = []
+
+    def request_stop(signum, frame):
+        stop.set()
+        stop_requested.append(time.time())
+        print(f'Stopping: {n_workers} worker(s) finishing their current batch'
+              if len(stop_requested) == 1 else 'Terminating the workers')
+    previous_handlers = {s: signal.signal(s, request_stop) for s in (signal.SIGTERM, signal.SIGINT)}
+
+    def start_worker(i):
+        p = mp.Process(target=_worker, name=f'populate-worker-{i}',
+                       args=(tables, stop, heartbeat_interval, poll_interval, batch_size, settings))
+        p.start()
+        return p
+
+    start = time.time()
+    workers = [start_worker(i) for i in range(n_workers)]
+    restarts, released, last_reclaim = 0, set(), time.time()
+    try:
+        while any(p.is_alive() for p in workers):
+            time.sleep(1)
+            for i, p in enumerate(workers):
+                if p.is_alive() or p.exitcode == 0 or p.pid in released:
+                    continue
+                released.add(p.pid)
+                print(f'!!! {p.name} (pid {p.pid}) exited with code {p.exitcode} - '
+                      f'released {release_worker_jobs(jobs_tables, p.pid)} job(s)')
+                if not stop.is_set() and restarts < n_workers:
+                    restarts += 1
+                    workers[i] = start_worker(i)
+            if stop_requested and (len(stop_requested) > 1 or time.time() - stop_requested[0] > shutdown_timeout):
+                for p in workers:
+                    if p.is_alive():
+                        p.terminate()  # SIGTERM - populate records the interrupted key as an error, released below
+                for p in workers:
+                    p.join()
+                    release_worker_jobs(jobs_tables, p.pid)
+                break
+            if time.time() - last_reclaim > heartbeat_interval:
+                reclaimed = reclaim_stale_jobs(jobs_tables, stale_timeout)
+                if reclaimed:
+                    print(f'Reclaimed {reclaimed} stale reservation(s)')
+                last_reclaim = time.time()
+    finally:
+        for s, handler in previous_handlers.items():
+            signal.signal(s, handler)
+    print(f'{"Stopped" if stop.is_set() else "Done"}: {n_workers} worker(s), {restarts} restart(s), '
+          f'{(time.time() - start) / 60:.1f} min')
@@ -0,0 +1,145 @@
+'''
+Opt-in profiling of the make() of the imported/computed tables of the pipeline: each call of the selected tables
+runs under cProfile, and the profile of the calls slower than a threshold is kept - a ".prof" file (pstats format)
+and, in "profiles.jsonl" of the same directory, the table, key and duration of the call.
+
+    from pipeline import profiling
+    profiling.enable('profiles', tables=['extracellular.UnitSpikeTimes'], threshold=30)
+
+or set "profiling": {"directory": ..., "tables": [...], "threshold": ...} in dj.config['custom'] and call enable()
+'''
+import os
+import re
+import json
+import time
+import pstats
+import cProfile
+import platform
+import functools
+from collections import defaultdict
+from datetime import datetime
+import datajoint as dj
+
+from .instrumentation import get_tables
+
+
+records_filename = 'profiles.jsonl'
+
+_patched = []  # (table, original make)
+_settings = {}
+_active = []  # cProfile does not nest - a make() called within a profiled make() is not profiled on its own
+
+
+def _make(table_name, func):
+    @functools.wraps(func)
+    def wrapper(self, key, *args, **kwargs):
+        if _active:
+            return func(self, key, *args, **kwargs)
+        profile = cProfile.Profile()
+        _active.append(profile)
+        status, start = 'ok', time.perf_counter()
+        try:
+            return profile.runcall(func, self, key, *args, **kwargs)
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            _active.pop()
+            duration = time.perf_counter() - start
+            if duration >= _settings['threshold']:
+                _save(profile, table_name, key, duration, status)
+    return wrapper
+
+
+def _save(profile, table_name, key, duration, status):
+    directory = _settings['directory']
+    now = datetime.now()
+    profile_path = os.path.join(directory, f'{table_name}_{now:%Y%m%d_%H%M%S_%f}_{os.getpid()}.prof')
+    profile.dump_stats(profile_path)
+    record = dict(table=table_name, key=key, duration=duration, status=status, profile=os.path.basename(profile_path),
+                  time=now.isoformat(), host=platform.node(), pid=os.getpid())
+    with open(os.path.join(directory, records_filename), 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+
+def enable(directory=None, tables=None, threshold=None):
+    '''
+    Profile the make() of "tables" (names, e.g. "extracellular.UnitSpikeTimes" - default: all tables of the pipeline)
+    and keep, in "directory", the profile of the calls taking "threshold" seconds or more (default: 0, all calls)
+    Defaults: "profiling" in dj.config['custom']
+    '''
+    if _patched:
+        return
+    config = dj.config['custom'].get('profiling', {})
+    _settings.update(directory=directory or config.get('directory', 'profiles'),
+                     threshold=threshold if threshold is not None else config.get('threshold', 0))
+    os.makedirs(_settings['directory'], exist_ok=True)
+
+    all_tables = get_tables()
+    tables = tables or config.get('tables') or list(all_tables)
+    unknown = set(tables) - set(all_tables)
+    if unknown:
+        raise ValueError(f'Unknown table(s): {sorted(unknown)} - valid names: {sorted(all_tables)}')
+    for table_name in tables:
+        table = all_tables[table_name]
+        _patched.append((table, table.make))
+        table.make = _make(table_name, table.make)
+
+
+def disable():
+    while _patched:
+        table, original = _patched.pop()
+        table.make = original
+
+
+def load_records(directory):
+    with open(os.path.join(directory, records_filename), 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _function_name(func):
+    filename, line, name = func
+    if filename == '~':  # built-in
+        return name
+    return f'{re.sub(".*site-packages" + re.escape(os.sep), "", filename)}:{line}({name})'
+
+
+def top_functions(stats, n, sort='tottime'):
+    # the "n" functions of "stats" (pstats.Stats) with the most "sort" (tottime or cumtime) time:
+    # (function, calls, own time, cumulative time)
+    columns = {'tottime': 2, 'cumtime': 3}
+    rows = sorted(stats.stats.items(), key=lambda x: -x[1][columns[sort]])[:n]
+    return [(_function_name(func), nc, tt, ct) for func, (cc, nc, tt, ct, callers) in rows]
+
+
+def _print_functions(functions, indent):
+    for name, calls, own, cumulative in functions:
+        print(f'{indent}{own:8.2f}s own {cumulative:8.2f}s cum {calls:>9} call(s)  {name}')
+
+
+def report(directory, top=10, functions=5, sort='tottime'):
+    '''
+    Print the "top" slowest profiled keys across all tables with the "functions" functions they spent most time in,
+    then, per table, the functions most time was spent in over all of its profiled calls
+    "sort": rank the functions by own time ("tottime") or by cumulative time ("cumtime")
+    '''
+    records = load_records(directory)
+    by_table = defaultdict(list)
+    for r in records:
+        by_table[r['table']].append(r)
+    print(f'{len(records)} profiled make() call(s) of {len(by_table)} table(s) in {directory}')
+
+    print('=================================')
+    print(f'Slowest {min(top, len(records))} key(s):')
+    for r in sorted(records, key=lambda r: -r['duration'])[:top]:
+        print(f'{r["duration"]:.2f}s {r["table"]}{" (error)" if r["status"] == "error" else ""} - {r["key"]}'
+              f' [{r["profile"]}]')
+        _print_functions(top_functions(pstats.Stats(os.path.join(directory, r['profile'])), functions, sort), '\t')
+
+    for table, rs in sorted(by_table.items(), key=lambda x: -sum(r['duration'] for r in x[1])):
+        durations = sorted(r['duration'] for r in rs)
+        print('=================================')
+        print(f'{table}: {len(rs)} profiled call(s) - total {sum(durations):.1f}s, '
+              f'median {durations[len(durations) // 2]:.2f}s, max {durations[-1]:.2f}s')
+        stats = pstats.Stats(*(os.path.join(directory, r['profile']) for r in rs))
+        _print_functions(top_functions(stats, functions, sort), '\t')
@@ -0,0 +1,119 @@
+'''
+Concurrent populate of the computed/imported tables, following their dependency graph.
+Each table is populated by its own worker process(es) - a downstream table starts as soon as some of its upstream
+keys are ready (its key_source only yields the keys whose upstream rows exist), and its workers stop once all of its
+upstream tables are done and a populate pass has seen their final content.
+A pass only runs when the upstream tables changed since the previous one, so keys whose make() inserts nothing are
+not re-run on every poll.
+'''
+import time
+import multiprocessing as mp
+import networkx as nx
+import datajoint as dj
+
+from . import utilities
+
+
+default_settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False}
+
+
+def table_name(table):
+    # e.g. "extracellular.UnitSpikeTimes" - the name used for the per-table worker counts
+    return f'{table.__module__.split(".")[-1]}.{table.__name__}'
+
+
+def get_upstream(tables):
+    '''
+    For each of "tables", the set of "tables" it depends on:
+     + its ancestors in the foreign-key graph of the schemas
+     + the tables its key_source is restricted by (e.g. "& acquisition.TrialSet")
+    '''
+    dependencies = dj.conn().dependencies
+    dependencies.load()
+    full_names = {table.full_table_name: table for table in tables}
+    upstream = {}
+    for table in tables:
+        ancestors = nx.ancestors(dependencies, table.full_table_name)
+        key_source_sql = table().key_source.make_sql()
+        upstream[table] = {t for name, t in full_names.items()
+                           if t is not table and (name in ancestors or name in key_source_sql)}
+    return upstream
+
+
+def topological_order(upstream):
+    # the tables ordered upstream first - ties in the given order
+    ordered, remaining = [], list(upstream)
+    while remaining:
+        ready = [t for t in remaining if not upstream[t] - set(ordered)]
+        if not ready:
+            raise ValueError(f'Cyclic dependency between: {[table_name(t) for t in remaining]}')
+        ordered.extend(ready)
+        remaining = [t for t in remaining if t not in ready]
+    return ordered
+
+
+def _populate_worker(table, upstream, upstream_done, poll_interval, settings):
+    utilities.reset_connection()
+    last_counts = None
+    while True:
+        # only a pass started after all upstream tables are done is guaranteed to see all the keys
+        is_final = all(event.is_set() for event in upstream_done)
+        # a pass only runs if the upstream tables changed since the previous one - so the keys it leaves
+        # unfinished (e.g. whose make() inserts nothing) are not re-run on every poll
+        counts = [len(t()) for t in upstream]
+        if counts != last_counts:
+            table.populate(**settings)
+            last_counts = counts
+        if is_final:
+            return
+        time.sleep(poll_interval)
+
+
+def populate_concurrently(tables, workers=None, poll_interval=None, settings=None):
+    '''
+    Populate "tables" concurrently, with workers[table_name(table)] worker processes per table
+    (default: "populate_workers" in dj.config['custom'], 1 for the tables not listed)
+    Downstream workers re-check for ready keys every "poll_interval" seconds
+    (default: "populate_poll_interval" in dj.config['custom'], or 10)
+    '''
+    workers = {**dj.config['custom'].get('populate_workers', {}), **(workers or {})}
+    poll_interval = poll_interval or dj.config['custom'].get('populate_poll_interval', 10)
+    settings = {**default_settings, **(settings or {})}
+
+    upstream = get_upstream(tables)
+    ordered = topological_order(upstream)
+    done = {table: mp.Event() for table in ordered}
+
+    start = time.time()
+    processes = {}
+    for table in ordered:
+        n_workers = workers.get(table_name(table), 1)
+        print(f'{table_name(table)}: {n_workers} worker(s), upstream: {[table_name(t) for t in upstream[table]]}')
+        processes[table] = [mp.Process(target=_populate_worker, name=f'{table_name(table)}-{i}',
+                                       args=(table, list(upstream[table]), [done[t] for t in upstream[table]],
+                                             poll_interval, settings))
+                            for i in range(n_workers)]
+        for p in processes[table]:
+            p.start()
+
+    # a table is done once all of its workers have exited
+    running = list(ordered)
+    while running:
+        for table in list(running):
+            if not any(p.is_alive() for p in processes[table]):
+                done[table].set()
+                running.remove(table)
+                failed = [p.name for p in processes[table] if p.exitcode != 0]
+                print(f'Done: {table_name(table)} ({time.time() - start:.1f}s)'
+                      + (f' - !!! FAILED WORKER(S): {failed}' if failed else ''))
+        time.sleep(min(poll_interval, 1))
+    print(f'Populated {len(ordered)} table(s) in {(time.time() - start) / 60:.1f} min')
+
+
+def populate_serially(tables, settings=None):
+    # populate "tables" one after the other, upstream first, in this process
+    settings = {**default_settings, **(settings or {})}
+    for table in topological_order(get_upstream(tables)):
+        start = time.time()
+        table.populate(**settings)
+        print(f'Done: {table_name(table)} ({time.time() - start:.1f}s)')
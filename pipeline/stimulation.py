@@ -101,3 +101,29 @@ class TrialSegmentedPhotoStimulus(dj.Computed):
 
         self.insert1(key)
         print(f'Perform trial-segmentation of photostim for trial: {key["trial_id"]}')
+
+
+@schema
+class TrialSegmentedPhotoStimulusMatrix(dj.Computed):
+    definition = """ # photostim of all trials of a session, segmented into one (trial x sample) matrix
+    -> PhotoStimulation
+    -> analysis.TrialSegmentationSetting
+    ---
+    trial_ids: longblob             # (trial) id of the trial of each row
+    segmented_photostim: longblob   # (mW) (trial x sample), NaN where out of the trial
+    """
+
+    # custom key_source where acquisition.PhotoStimulation.photostim_timeseries exist
+    key_source = ((PhotoStimulation - 'photostim_timeseries is NULL')
+                  * analysis.TrialSegmentationSetting) & acquisition.TrialSet
+
+    def make(self, key):
+        # get raw
+        fs, first_time_point, photostim_timeseries = (PhotoStimulation & key).fetch1(
+            'photostim_sampling_rate', 'photostim_start_time', 'photostim_timeseries')
+        # segmentation
+        (trial_ids, (segmented_photostim,)), = analysis.perform_session_trial_segmentation(
+            key, fs, first_time_point, (photostim_timeseries,), max_bytes=np.inf,
+            source=analysis.get_source_id(PhotoStimulation, key))
+        self.insert1(dict(key, trial_ids=trial_ids, segmented_photostim=segmented_photostim))
+        print(f'Perform trial-segmentation of photostim for {len(trial_ids)} trials')
@@ -1,13 +1,27 @@
 import os
+import json
+import time
+import hashlib
+import atexit
+import tempfile
+import multiprocessing as mp
+import multiprocessing.util
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime
 import re
+import numpy as np
 import h5py as h5
+import datajoint as dj
 
 
 # datetime format - should probably read this from a config file and not hard coded here
 datetimeformat_ymdhms = '%Y-%m-%d %H:%M:%S'
 datetimeformat_ymd = '%Y-%m-%d'
 
+# default memory budget of one batch of rows to be inserted - see "insert_batch_bytes" in dj.config['custom']
+default_insert_batch_bytes = 64 * 1024 ** 2
+
 
 def parse_prefix(line):
     cover = len(datetime.now().strftime(datetimeformat_ymdhms))
@@ -23,37 +37,318 @@ def parse_prefix(line):
             return None    
 
 
-def find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment):
-    ############## Dataset #################
+def file_sha1(filepath, block_size=8 * 1024 ** 2):
+    # sha1 hash of the content of a file, read in blocks of "block_size" bytes
+    sha1 = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def parallel_map(func, items, processes=None, initializer=None):
+    # apply "func" to each of "items" over a process pool, yield the results in order of completion
+    processes = processes or 1
+    if processes <= 1:
+        if initializer is not None:
+            initializer()
+        yield from map(func, items)
+        return
+    with mp.Pool(processes, initializer=initializer) as pool:
+        yield from pool.imap_unordered(func, items)
+
+
+def reset_connection():
+    # pool initializer - each worker process holds its own database connection
+    dj.conn(reset=True)
+
+
+def read_nwb_header(filepath, which_data):
+    # read only the few scalar datasets identifying the session of one NWB file
+    with h5.File(filepath, 'r') as nwb:
+        subject_id = nwb['general']['subject']['subject_id'].value.decode('UTF-8').lower()
+        session_start_time = nwb['session_start_time'].value
+        identifier = nwb['identifier'].value
+    if isinstance(identifier, bytes):
+        identifier = identifier.decode('UTF-8')
+
+    # -- session_time - due to error in extracellular dataset (session_start_time error), need to hard code here...
+    if which_data == 'whole_cell':  # case: whole cell
+        session_time = parse_prefix(session_start_time)
+    elif which_data == 'extracellular':  # case: extracellular
+        session_time = parse_prefix(re.split(';\s?', identifier)[-1].replace('T', ' '))
+    return dict(subject_id=subject_id, identifier=identifier,
+                session_time=session_time.strftime(datetimeformat_ymdhms) if session_time is not None else None)
+
+
+def _scan_nwbfile(args):
+    # index entry of one file - errors are recorded in the entry so an unreadable file is only tried once
+    filepath, which_data, size, mtime = args
+    entry = dict(size=size, mtime=mtime, subject_id=None, session_time=None, identifier=None, error=None)
+    try:
+        entry.update(read_nwb_header(filepath, which_data))
+    except Exception as e:
+        entry['error'] = str(e) or type(e).__name__
+    return os.path.basename(filepath), entry
+
+
+class SessionIndex:
+    '''
+    On-disk index of one data directory: (subject_id, session_time) -> filename
+    Each file entry is keyed by its size and mtime, so only new or changed files are ever opened
+    '''
+    index_filename = '.session_index.json'
 
-    sess_data_files = os.listdir(sess_data_dir)
-    which_data = re.search('extracellular|whole_cell', sess_data_dir).group()
-    # Search the filenames to find a match for "this" session (based on key)
-    sess_data_file = None
-    for s in sess_data_files:
+    def __init__(self, sess_data_dir, index_path=None):
+        self.sess_data_dir = sess_data_dir
+        self.which_data = re.search('extracellular|whole_cell', sess_data_dir).group()
+        if index_path is None:
+            index_dir = dj.config['custom'].get('session_index_directory')
+            if index_dir is None:
+                index_path = os.path.join(sess_data_dir, self.index_filename)
+            else:
+                dir_hash = hashlib.sha1(os.path.abspath(sess_data_dir).encode()).hexdigest()[:12]
+                index_path = os.path.join(index_dir, f'{self.which_data}_{dir_hash}{self.index_filename}')
+        self.index_path = index_path
+        self.files = {}  # filename -> {'size', 'mtime', 'subject_id', 'session_time', 'identifier', 'error'}
+        self.sessions = {}  # (subject_id, session_time) -> filename
+        self._dir_mtime = None  # mtime of the data directory at the last update() of this process
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                self.files = json.load(f).get('files', {})
+        except (OSError, ValueError):
+            self.files = {}
+        self._build_sessions()
+
+    def save(self):
+        # written to a temporary file of its own, as other processes may save the same index concurrently
+        tmp_path = None
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.index_path) or '.',
+                                             prefix=os.path.basename(self.index_path) + '.', suffix='.tmp',
+                                             delete=False) as f:
+                tmp_path = f.name
+                json.dump({'sess_data_dir': self.sess_data_dir, 'files': self.files}, f)
+            os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            print(f'Warning: could not save session index to {self.index_path} - {str(e)}')
+            if tmp_path is not None and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def _build_sessions(self):
+        self.sessions = {}
+        for fname in sorted(self.files):
+            entry = self.files[fname]
+            if entry['error'] is None and entry['session_time'] is not None:
+                self.sessions.setdefault((entry['subject_id'], entry['session_time']), fname)
+
+    def _stat(self, fname):
+        try:
+            st = os.stat(os.path.join(self.sess_data_dir, fname))
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def _get_dir_mtime(self):
         try:
-            temp_nwb = h5.File(os.path.join(sess_data_dir, s), 'r')
-        except:
-            print(f'!!! error load file: {s}')
-            continue
-        # read subject_id out of this file
-        subject_id = temp_nwb['general']['subject']['subject_id'].value.decode('UTF-8').lower()
-
-        # -- session_time - due to error in extracellular dataset (session_start_time error), need to hard code here...
-        if which_data == 'whole_cell':  # case: whole cell
-            session_start_time = temp_nwb['session_start_time'].value
-            session_start_time = parse_prefix(session_start_time)
-        elif which_data == 'extracellular':# case: extracellular
-            identifier = temp_nwb['identifier'].value
-            session_start_time = re.split(';\s?', identifier)[-1].replace('T', ' ')
-            session_start_time = parse_prefix(session_start_time)
-
-        # compare key with extracted info from this file
-        if (animal_id == subject_id) and (date_of_experiment == session_start_time):
-            # if true, meaning the current "nwb" variable is a match with this session
-            sess_data_file = s
-            break
-        temp_nwb.close()
+            return os.stat(self.sess_data_dir).st_mtime_ns
+        except OSError:
+            return None
+
+    def _is_current(self, fname):
+        entry = self.files.get(fname)
+        return entry is not None and self._stat(fname) == (entry['size'], entry['mtime'])
+
+    def update(self, processes=None):
+        # incremental update - drop removed files, (re)read only new or changed ones
+        processes = processes or dj.config['custom'].get('session_index_processes', 1)
+        self._dir_mtime = self._get_dir_mtime()
+        fnames = os.listdir(self.sess_data_dir)
+        removed = set(self.files) - set(fnames)
+        files, to_scan = {}, []
+        for fname in fnames:
+            if fname == os.path.basename(self.index_path) or fname.endswith('.tmp'):
+                continue
+            stat = self._stat(fname)
+            if stat is None:
+                continue
+            entry = self.files.get(fname)
+            if entry is None or (entry['size'], entry['mtime']) != stat:
+                to_scan.append((os.path.join(self.sess_data_dir, fname), self.which_data, *stat))
+            else:
+                files[fname] = entry
+
+        start = time.time()
+        for fname, entry in parallel_map(_scan_nwbfile, to_scan, processes=min(processes, len(to_scan))):
+            files[fname] = entry
+            if entry['error'] is not None:
+                print(f'!!! error load file: {fname} - {entry["error"]}')
+        duration = time.time() - start
+
+        self.files = files
+        self._build_sessions()
+        if removed or to_scan:
+            self.save()
+            if os.path.dirname(os.path.abspath(self.index_path)) == os.path.abspath(self.sess_data_dir):
+                self._dir_mtime = self._get_dir_mtime()  # saving the index in the directory changes its mtime
+        return len(to_scan), duration
+
+    def lookup(self, animal_id, date_of_experiment):
+        session_time = (date_of_experiment.strftime(datetimeformat_ymdhms)
+                        if isinstance(date_of_experiment, datetime) else str(date_of_experiment))
+        fname = self.sessions.get((animal_id, session_time))
+        if fname is not None and self._is_current(fname):
+            return fname
+        # index miss - no such session unless files were added, removed or renamed since the last update
+        # (e.g. the extracellular directory looked up for a whole-cell session)
+        if fname is None and self._dir_mtime is not None and self._get_dir_mtime() == self._dir_mtime:
+            return None
+        # stale entry, or directory changed - refresh and retry
+        self.update()
+        return self.sessions.get((animal_id, session_time))
+
+
+_session_indexes = {}
+
+
+def get_session_index(sess_data_dir):
+    if sess_data_dir not in _session_indexes:
+        _session_indexes[sess_data_dir] = SessionIndex(sess_data_dir)
+    return _session_indexes[sess_data_dir]
+
+
+def build_session_index(sess_data_dir, processes=None):
+    # (re)build the session index of a data directory by scanning new or changed files over a process pool
+    index = get_session_index(sess_data_dir)
+    processes = processes or mp.cpu_count()
+    file_count, duration = index.update(processes=processes)
+    unreadable = [f for f, entry in index.files.items() if entry['error'] is not None]
+    rate = file_count / duration if duration > 0 else float('nan')
+    print(f'Scanned {file_count} file(s) of {sess_data_dir} in {duration:.2f}s '
+          f'({rate:.1f} files/s, {processes} worker(s)) - '
+          f'{len(index.sessions)} session(s) indexed, {len(unreadable)} unreadable file(s)')
+    return index
+
+
+class H5FilePool:
+    '''
+    Process-wide, bounded LRU pool of read-only h5py.File handles, shared across make() calls
+    A handle is evicted (closed) when the pool is over "max_size" or the handle is idle for more than "max_idle" seconds,
+     handles currently borrowed are never evicted
+    '''
+
+    def __init__(self, max_size=4, max_idle=None):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._handles = OrderedDict()  # filepath -> [h5.File, borrow count, last used time, (size, mtime) of the file]
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        # handles inherited from a forked parent are not safe to use nor to close here
+        if os.getpid() != self._pid:
+            self._handles = OrderedDict()
+            self._pid = os.getpid()
+
+    def _evict(self):
+        now = time.time()
+        for filepath, (f, borrow_count, last_used, _) in list(self._handles.items()):
+            if borrow_count:
+                continue
+            if len(self._handles) > self.max_size or (self.max_idle is not None and now - last_used > self.max_idle):
+                self.close(filepath)
+
+    @contextmanager
+    def borrow(self, filepath):
+        self._check_pid()
+        filepath = os.path.abspath(filepath)
+        st = os.stat(filepath)
+        file_version = (st.st_size, st.st_mtime_ns)
+        if filepath in self._handles and not self._handles[filepath][1] and self._handles[filepath][3] != file_version:
+            self.close(filepath)  # replaced or rewritten since opened
+        if filepath in self._handles:
+            self._handles.move_to_end(filepath)
+        else:
+            self._handles[filepath] = [h5.File(filepath, 'r'), 0, time.time(), file_version]
+        handle = self._handles[filepath]
+        handle[1] += 1
+        try:
+            yield handle[0]
+        finally:
+            handle[1] -= 1
+            handle[2] = time.time()
+            self._evict()
+
+    def close(self, filepath):
+        f = self._handles.pop(os.path.abspath(filepath))[0]
+        try:
+            f.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        self._check_pid()
+        for filepath in list(self._handles):
+            self.close(filepath)
+
+    def __len__(self):
+        return len(self._handles)
+
+
+h5_file_pool = H5FilePool(max_size=dj.config['custom'].get('h5_pool_size', 4),
+                          max_idle=dj.config['custom'].get('h5_pool_max_idle'))
+
+
+def _register_pool_finalizer(pool):
+    pool._check_pid()
+    mp.util.Finalize(pool, pool.close_all, exitpriority=10)
+
+
+# close the pooled handles when this process exits - multiprocessing workers skip "atexit" but run their finalizers
+atexit.register(h5_file_pool.close_all)
+_register_pool_finalizer(h5_file_pool)
+mp.util.register_after_fork(h5_file_pool, _register_pool_finalizer)
+
+
+def row_nbytes(row):
+    # approximate size of one row to be inserted, dominated by its array (blob) attributes
+    return sum(v.nbytes if isinstance(v, np.ndarray) else 8 for v in row.values())
+
+
+def batched_by_bytes(rows, max_bytes=None):
+    # group rows into lists of at most "max_bytes" (a single larger row makes a batch of its own)
+    max_bytes = max_bytes or dj.config['custom'].get('insert_batch_bytes', default_insert_batch_bytes)
+    batch, batch_bytes = [], 0
+    for row in rows:
+        nbytes = row_nbytes(row)
+        if batch and batch_bytes + nbytes > max_bytes:
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(row)
+        batch_bytes += nbytes
+    if batch:
+        yield batch
+
+
+@contextmanager
+def transaction(connection):
+    # start a transaction, unless already in one (e.g. make() called from populate())
+    if connection.in_transaction:
+        yield
+    else:
+        with connection.transaction:
+            yield
+
+
+def find_session_matched_nwbfile(sess_data_dir, animal_id, date_of_experiment):
+    ############## Dataset #################
+    # Search the session index to find a match for "this" session (based on key)
+    sess_data_file = get_session_index(sess_data_dir).lookup(animal_id, date_of_experiment)
 
     # If session not found from dataset, break
     if sess_data_file is None:
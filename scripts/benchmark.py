@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+'''
+End-to-end benchmark of the pipeline on a synthetic dataset (see synthetic_nwb.py): ingest -> populate -> export
+to NWB 2.0, each stage timed, against a local MySQL server (e.g. "docker-compose up -d db_guo_inagaki_2017").
+The schemas are created with the "benchmark_" prefix, dropped before the run (and after it unless --keep).
+
+    python scripts/benchmark.py --extracellular 4 --whole-cell 4 --output results.json
+    python scripts/benchmark.py --extracellular 4 --whole-cell 4 --baseline results.json --tolerance 0.2
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import importlib
+from datetime import datetime
+import datajoint as dj
+
+sys.path.append(os.path.dirname(__file__))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import synthetic_nwb
+
+
+schema_prefix = 'benchmark_'
+
+
+def drop_schemas(prefix=schema_prefix):
+    # drop all schemas starting with "prefix" - foreign key checks off, as the schemas reference each other
+    connection = dj.conn()
+    schemas = [s for s, in connection.query('SHOW DATABASES LIKE %s', args=(prefix.replace('_', r'\_') + '%',))]
+    connection.query('SET FOREIGN_KEY_CHECKS=0')
+    try:
+        for schema in schemas:
+            connection.query(f'DROP DATABASE `{schema}`')
+    finally:
+        connection.query('SET FOREIGN_KEY_CHECKS=1')
+    return schemas
+
+
+def _directory_size(directory):
+    return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(directory) for f in files)
+
+
+def run(work_dir, extracellular, whole_cell, processes=1, populate_workers=None, serial=False, stream=False,
+        **dataset_kwargs):
+    '''
+    Generate the synthetic dataset in "work_dir", then time its ingest, populate and export
+    Return the results: the parameters and, per stage, its duration (s) and throughput
+    '''
+    directories = synthetic_nwb.generate_dataset(os.path.join(work_dir, 'data'), extracellular, whole_cell,
+                                                 **dataset_kwargs)
+    # the pipeline modules read the schema prefix and the data directories at import
+    dj.config['custom'] = {**(dj.config.get('custom') or {}), 'database.prefix': schema_prefix,
+                           'extracellular_directory': directories['extracellular'],
+                           'intracellular_directory': directories['whole_cell'],
+                           'session_index_directory': work_dir}
+    print(f'Dropped schema(s): {drop_schemas()}')
+
+    from pipeline import acquisition, ingestion, scheduler
+    import populate
+    import datajoint_to_nwb
+
+    results = dict(time=datetime.now().isoformat(), host=platform.node(), database=dj.config['database.host'],
+                   parameters=dict(synthetic_nwb.defaults, **dataset_kwargs, extracellular=extracellular,
+                                   whole_cell=whole_cell, processes=processes, populate_workers=populate_workers,
+                                   serial=serial, stream=stream),
+                   input_bytes=_directory_size(os.path.join(work_dir, 'data')), stages={})
+
+    def timed(stage, func, count, unit):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        results['stages'][stage] = {'seconds': duration, 'count': count,
+                                    f'{unit}_per_min': count / duration * 60 if duration > 0 else None}
+
+    # -- ingest
+    for module_name, which_data in (('ingest_nwb_extracellular', 'extracellular'),
+                                    ('ingest_nwb_wholecell', 'whole_cell')):
+        module = importlib.import_module(module_name)
+        timed(f'ingest_{which_data}', lambda: ingestion.ingest_files(module.ingest_file, module.path, which_data,
+                                                                     processes=processes),
+              len(os.listdir(module.path)), 'files')
+
+    # -- populate
+    def populate_tables():
+        if serial:
+            scheduler.populate_serially(populate.tables)
+        else:
+            scheduler.populate_concurrently(populate.tables, workers={
+                scheduler.table_name(t): populate_workers for t in populate.tables} if populate_workers else None)
+    timed('populate', populate_tables, len(populate.tables), 'tables')
+    results['rows'] = {scheduler.table_name(t): len(t()) for t in populate.tables}
+
+    # -- export
+    session_keys = acquisition.Session.fetch('KEY')
+    nwb_output_dir = os.path.join(work_dir, 'nwb')
+    timed('export', lambda: datajoint_to_nwb.export_sessions(session_keys, nwb_output_dir, processes=processes,
+                                                             stream=stream),
+          len(session_keys), 'sessions')
+    results['output_bytes'] = _directory_size(nwb_output_dir)
+    results['total_seconds'] = sum(stage['seconds'] for stage in results['stages'].values())
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # the stages slower than in "baseline" by more than "tolerance" (fraction) - (stage, seconds, baseline seconds)
+    return [(stage, r['seconds'], baseline['stages'][stage]['seconds'])
+            for stage, r in results['stages'].items()
+            if stage in baseline['stages'] and r['seconds'] > baseline['stages'][stage]['seconds'] * (1 + tolerance)]
+
+
+def print_results(results):
+    print('=================================')
+    print(f'Benchmark: {results["parameters"]} - input {results["input_bytes"] / 1024 ** 2:.1f} MB, '
+          f'output {results["output_bytes"] / 1024 ** 2:.1f} MB')
+    for stage, r in results['stages'].items():
+        rate = next((f'{v:.1f} {k.replace("_per_", "/")}' for k, v in r.items() if k.endswith('_per_min') and v), '')
+        print(f'\t{stage}: {r["seconds"]:.1f}s - {rate}')
+    print(f'\ttotal: {results["total_seconds"]:.1f}s')
+    print('=================================')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time ingest, populate and export of a synthetic dataset')
+    parser.add_argument('--host', help='database host, e.g. localhost:4306 (default: dj.config)')
+    parser.add_argument('--user', help='database user (default: dj.config)')
+    parser.add_argument('--password', help='database password (default: dj.config)')
+    parser.add_argument('--extracellular', type=int, default=2, help='number of extracellular sessions (default: 2)')
+    parser.add_argument('--whole-cell', type=int, default=2, help='number of whole-cell sessions (default: 2)')
+    for name, value in synthetic_nwb.defaults.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(value), default=value,
+                            help=f'(default: {value})')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='number of worker processes of the ingest and of the export (default: 1)')
+    parser.add_argument('--populate-workers', type=int, default=None,
+                        help='number of worker processes per table (default: 1)')
+    parser.add_argument('--serial', action='store_true', help='populate the tables one after the other')
+    parser.add_argument('--stream', action='store_true', help='streaming export (see datajoint_to_nwb.py)')
+    parser.add_argument('--work-dir', help='directory of the synthetic files and of the export (default: temporary)')
+    parser.add_argument('--keep', action='store_true', help='keep the schemas and the temporary files')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run - exit with code 1 if a stage is slower')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown of a stage over the baseline reported as a regression (default: 0.2)')
+    args = vars(parser.parse_args())
+
+    for name in ('host', 'user', 'password'):
+        value = args.pop(name)
+        if value is not None:
+            dj.config[f'database.{name}'] = value
+    output, baseline, tolerance, keep = (args.pop(k) for k in ('output', 'baseline', 'tolerance', 'keep'))
+    work_dir = args.pop('work_dir')
+    is_temporary = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+
+    try:
+        results = run(work_dir, **args)
+    finally:
+        if not keep:
+            drop_schemas()
+            if is_temporary:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    print_results(results)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if baseline:
+        with open(baseline, 'r') as f:
+            regressions = compare(results, json.load(f), tolerance)
+        for stage, seconds, baseline_seconds in regressions:
+            print(f'!!! REGRESSION: {stage} {seconds:.1f}s vs. {baseline_seconds:.1f}s in {baseline}')
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,24 @@
+import os, sys
+import argparse
+import pathlib
+import datajoint as dj
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pipeline import utilities
+
+
+# ================== Dataset ==================
+default_dirs = [pathlib.Path(dj.config['custom'].get(d)).as_posix()
+                for d in ('extracellular_directory', 'intracellular_directory')
+                if dj.config['custom'].get(d)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the session index of the NWB data directories')
+    parser.add_argument('directories', nargs='*', default=default_dirs,
+                        help='data directories to scan (default: the directories in dj_local_conf.json)')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes reading file headers (default: cpu count)')
+    args = parser.parse_args()
+
+    for sess_data_dir in args.directories:
+        utilities.build_session_index(sess_data_dir, processes=args.processes)
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 import os
 
-import sys
+import time
+import argparse
+import traceback
 from datetime import datetime
 from dateutil.tz import tzlocal
 import pytz
@@ -14,6 +16,9 @@ from pipeline import (reference, subject, acquisition, stimulation, analysis,
                       intracellular, extracellular, behavior, utilities)
 import pynwb
 from pynwb import NWBFile, NWBHDF5IO
+from hdmf.data_utils import AbstractDataChunkIterator, DataChunk
+from hdmf.backends.hdf5.h5_utils import H5DataIO
+import datajoint as dj
 
 warnings.filterwarnings('ignore', module='pynwb')
 
@@ -25,13 +30,84 @@ hardware_filter = 'Bandpass filtered 300-6K Hz'
 related_publications = 'doi:10.1038/nature22324'
 ecephys_fs = 25000
 
+# streaming export - default chunk size (samples) and gzip level of the traces, see "nwb_chunk_size" and
+# "nwb_compression_level" in dj.config['custom']
+default_chunk_size = 2 ** 17
+default_compression_level = 4
+
 # experiment description and keywords - from the abstract
 experiment_description = ''
 keywords = ['anterior lateral motor cortex', 'thalamus', 'persistent activity',
             'optogenetic perturbations', 'extracellular electrophysiology', 'intracellular electrophysiology']
 
 
-def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False, overwrite=True):
+class BlobChunkIterator(AbstractDataChunkIterator):
+    """
+    Chunks of the 1-D trace stored in the blob "attribute" of the single row of "query"
+    The blob is only fetched when the trace is written to the file, and released once written,
+    so a streaming export holds one trace in memory at a time instead of all traces of the session
+    """
+    def __init__(self, query, attribute, chunk_size, dtype=np.float64):
+        self.query = query
+        self.attribute = attribute
+        self.chunk_size = chunk_size
+        self._dtype = np.dtype(dtype)
+        self._data = None
+        self._start = 0
+        self._done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._done:
+            raise StopIteration
+        if self._data is None:
+            self._data = np.asarray(self.query.fetch1(self.attribute), dtype=self._dtype)
+        if self._start >= len(self._data):
+            self._data, self._done = None, True
+            raise StopIteration
+        stop = min(self._start + self.chunk_size, len(self._data))
+        chunk = DataChunk(data=self._data[self._start:stop], selection=np.s_[self._start:stop])
+        self._start = stop
+        return chunk
+
+    def recommended_chunk_shape(self):
+        return (self.chunk_size,)
+
+    def recommended_data_shape(self):
+        # the dataset grows with each chunk written
+        return (0,)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def maxshape(self):
+        return (None,)
+
+
+def get_trace(query, attribute, stream=None):
+    # trace in "attribute" of "query" - or, with stream=(chunk_size, compression_level), its chunked compressed writer
+    if stream is None:
+        return query.fetch1(attribute)
+    chunk_size, compression_level = stream
+    return H5DataIO(BlobChunkIterator(query, attribute, chunk_size),
+                    compression='gzip', compression_opts=compression_level)
+
+
+def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False, overwrite=True,
+                  stream=False, chunk_size=None, compression_level=None):
+    """
+    Build the NWBFile of the session "session_key", and write it in "nwb_output_dir" if "save"
+    With "stream", the traces (membrane potential, current injection, lick traces and photostim) are written
+    in chunks of "chunk_size" samples, gzip-compressed at "compression_level", fetching one trace at a time
+    """
+    stream = ((chunk_size or dj.config['custom'].get('nwb_chunk_size', default_chunk_size),
+               compression_level or dj.config['custom'].get('nwb_compression_level', default_compression_level))
+              if stream else None)
+
     this_session = (acquisition.Session & session_key).fetch1()
     # =============== General ====================
     # -- NWB file - a NWB2.0 file for each session
@@ -73,9 +149,10 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
             location='; '.join([f'{k}: {str(v)}'
                                 for k, v in (reference.ActionLocation & cell).fetch1().items()]))
         # acquisition - membrane potential
-        mp, mp_wo_spike, mp_start_time, mp_fs = (intracellular.MembranePotential & cell).fetch1(
-            'membrane_potential', 'membrane_potential_wo_spike',
+        mp_start_time, mp_fs = (intracellular.MembranePotential & cell).fetch1(
             'membrane_potential_start_time', 'membrane_potential_sampling_rate')
+        mp = get_trace(intracellular.MembranePotential & cell, 'membrane_potential', stream)
+        mp_wo_spike = get_trace(intracellular.MembranePotential & cell, 'membrane_potential_wo_spike', stream)
         nwbfile.add_acquisition(pynwb.icephys.PatchClampSeries(name='PatchClampSeries',
                                                                electrode=ic_electrode,
                                                                unit='mV',
@@ -85,8 +162,9 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                                                                starting_time=mp_start_time,
                                                                rate=mp_fs))
         # acquisition - current injection
-        current_injection, ci_start_time, ci_fs = (intracellular.CurrentInjection & cell).fetch1(
-            'current_injection', 'current_injection_start_time', 'current_injection_sampling_rate')
+        ci_start_time, ci_fs = (intracellular.CurrentInjection & cell).fetch1(
+            'current_injection_start_time', 'current_injection_sampling_rate')
+        current_injection = get_trace(intracellular.CurrentInjection & cell, 'current_injection', stream)
         nwbfile.add_stimulus(pynwb.icephys.CurrentClampStimulusSeries(name='CurrentClampStimulus',
                                                                       electrode=ic_electrode,
                                                                       conversion=1e-9,
@@ -137,7 +215,17 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
         nwbfile.add_unit_column(name='unit_z', description='z-coordinate of this unit (mm)')
         nwbfile.add_unit_column(name='cell_type', description='cell type (e.g. wide width, narrow width spiking)')
 
-        for unit in (extracellular.UnitSpikeTimes & probe_insertion).fetch(as_dict=True):
+        # waveform mean and SD from UnitWaveformSummary - computed from the raw waveforms only if not populated
+        waveform_summaries = {unit_id: (mean, sd) for unit_id, mean, sd in zip(
+            *(extracellular.UnitWaveformSummary & probe_insertion).fetch('unit_id', 'waveform_mean', 'waveform_sd'))}
+        for unit in (extracellular.UnitSpikeTimes & probe_insertion).proj(
+                *[a for a in extracellular.UnitSpikeTimes.heading.secondary_attributes
+                  if a != 'spike_waveform']).fetch(as_dict=True):
+            if unit['unit_id'] not in waveform_summaries:
+                summary = extracellular.summarize_waveforms(
+                    (extracellular.UnitSpikeTimes & unit).fetch1('spike_waveform'))
+                waveform_summaries[unit['unit_id']] = summary['waveform_mean'], summary['waveform_sd']
+            waveform_mean, waveform_sd = waveform_summaries[unit['unit_id']]
             # make an electrode table region (which electrode(s) is this unit coming from)
             nwbfile.add_unit(id=unit['unit_id'],
                              electrodes=(unit['channel_id']
@@ -148,31 +236,32 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                              unit_z=unit['unit_z'],
                              cell_type=unit['unit_cell_type'],
                              spike_times=unit['spike_times'],
-                             waveform_mean=np.mean(unit['spike_waveform'], axis=0),
-                             waveform_sd=np.std(unit['spike_waveform'], axis=0))
+                             waveform_mean=waveform_mean,
+                             waveform_sd=waveform_sd)
 
     # =============== Behavior ====================
-    behavior_data = ((behavior.LickTrace & session_key).fetch1()
-                     if behavior.LickTrace & session_key
-                     else None)
-    if behavior_data:
+    if behavior.LickTrace & session_key:
         behav_acq = pynwb.behavior.BehavioralTimeSeries(name='lick_trace')
         nwbfile.add_acquisition(behav_acq)
-        [behavior_data.pop(k) for k in behavior.LickTrace.primary_key]
-        lt_start_time = behavior_data.pop('lick_trace_start_time')
-        lt_fs = behavior_data.pop('lick_trace_sampling_rate')
-        for b_k, b_v in behavior_data.items():
+        lt_start_time, lt_fs = (behavior.LickTrace & session_key).fetch1(
+            'lick_trace_start_time', 'lick_trace_sampling_rate')
+        for b_k in behavior.LickTrace.heading.secondary_attributes:
+            if b_k in ('lick_trace_start_time', 'lick_trace_sampling_rate'):
+                continue
             behav_acq.create_timeseries(name=b_k,
                                         unit='a.u.',
                                         conversion=1.0,
-                                        data=b_v,
+                                        data=get_trace(behavior.LickTrace & session_key, b_k, stream),
                                         starting_time=lt_start_time,
                                         rate=lt_fs)
 
     # =============== Photostimulation ====================
-    photostim = ((stimulation.PhotoStimulation & session_key).fetch1()
-                       if stimulation.PhotoStimulation & session_key
-                       else None)
+    # the photostim timeseries is fetched separately, when written
+    photostim = ((stimulation.PhotoStimulation & session_key).proj(
+        *[a for a in stimulation.PhotoStimulation.heading.secondary_attributes if a != 'photostim_timeseries'],
+        has_timeseries='photostim_timeseries is not NULL').fetch1()
+                 if stimulation.PhotoStimulation & session_key
+                 else None)
     if photostim:
         photostim_device = (stimulation.PhotoStimDevice & photostim).fetch1()
         stim_device = nwbfile.create_device(name=photostim_device['device_name'])
@@ -185,13 +274,13 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
             description=(stimulation.PhotoStimulationInfo & photostim).fetch1('photo_stim_notes'))
         nwbfile.add_ogen_site(stim_site)
 
-        if photostim['photostim_timeseries'] is not None:
+        if photostim['has_timeseries']:
             nwbfile.add_stimulus(pynwb.ogen.OptogeneticSeries(
                 name='_'.join(['photostim_on', photostim['photostim_datetime'].strftime('%Y-%m-%d_%H-%M-%S')]),
                 site=stim_site,
                 resolution = 0.0,
                 conversion = 1e-3,
-                data = photostim['photostim_timeseries'],
+                data = get_trace(stimulation.PhotoStimulation & photostim, 'photostim_timeseries', stream),
                 starting_time = photostim['photostim_start_time'],
                 rate = photostim['photostim_sampling_rate']))
 
@@ -226,31 +315,34 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
         photostim_tag_default = {tag: '' for tag in stimulation.TrialPhotoStimInfo.heading.names
                                  if tag not in stimulation.TrialPhotoStimInfo.primary_key}
 
-        # Add entry to the trial-table
-        for trial in (acquisition.TrialSet.Trial & session_key).fetch(as_dict=True):
-            events = dict(zip(*(acquisition.TrialSet.EventTime & trial
-                                & [{'trial_event': e} for e in trial_events]).fetch('trial_event', 'event_time')))
+        # Add entry to the trial-table - the trials, their photostim info and their event times of the session
+        # are fetched at once, then assembled per trial in memory
+        trials = (acquisition.TrialSet.Trial & session_key).fetch(as_dict=True, order_by='trial_id')
+        trial_photostims = {t['trial_id']: t for t in (stimulation.TrialPhotoStimInfo & session_key).fetch(as_dict=True)}
+        trial_events_times = {trial['trial_id']: {} for trial in trials}
+        for trial_id, trial_event, event_time in zip(*(acquisition.TrialSet.EventTime & session_key
+                                                       & [{'trial_event': e} for e in trial_events]).fetch(
+                'trial_id', 'trial_event', 'event_time')):
+            trial_events_times[trial_id][trial_event + '_time'] = event_time
 
-            trial_tag_value = ({**trial, **events, **(stimulation.TrialPhotoStimInfo & trial).fetch1()}
-                               if (stimulation.TrialPhotoStimInfo & trial)
-                               else {**trial, **events, **photostim_tag_default})
+        for trial in trials:
+            photostim_tags = trial_photostims.get(trial['trial_id'], photostim_tag_default)
+            trial_tag_value = {**trial, **{k: photostim_tags[k] for k in photostim_tag_default}}
 
             # rename 'trial_id' to 'id'
             trial_tag_value['id'] = trial_tag_value['trial_id']
             [trial_tag_value.pop(k) for k in acquisition.TrialSet.Trial.primary_key]
 
-            # Final tweaks: i) add '_time' suffix and ii) remove 'trial_' prefix
-            events = {k + '_time': trial_tag_value.pop(k) for k in events}
+            # Final tweaks: i) add '_time' suffix (above) and ii) remove 'trial_' prefix
             trial_attrs = {k.replace('trial_', ''): trial_tag_value.pop(k)
                            for k in [n for n in trial_tag_value if n.startswith('trial_')]}
 
-            nwbfile.add_trial(**trial_tag_value, **events, **trial_attrs)
+            nwbfile.add_trial(**trial_tag_value, **trial_events_times[trial['trial_id']], **trial_attrs)
 
     # =============== Write NWB 2.0 file ===============
     if save:
         save_file_name = ''.join([nwbfile.identifier, '.nwb'])
-        if not os.path.exists(nwb_output_dir):
-            os.makedirs(nwb_output_dir)
+        os.makedirs(nwb_output_dir, exist_ok=True)  # concurrent exports may create it at the same time
         if not overwrite and os.path.exists(os.path.join(nwb_output_dir, save_file_name)):
             return nwbfile
         with NWBHDF5IO(os.path.join(nwb_output_dir, save_file_name), mode = 'w') as io:
@@ -262,12 +354,60 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
 
 # ============================== EXPORT ALL ==========================================
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        nwb_outdir = sys.argv[1]
-    else:
-        nwb_outdir = default_nwb_output_dir
+def _export_session(args):
+    session_key, nwb_output_dir, export_kwargs = args
+    start = time.time()
+    try:
+        export_to_nwb(session_key, nwb_output_dir=nwb_output_dir, save=True, **export_kwargs)
+    except Exception as e:
+        traceback.print_exc()
+        return session_key, f'{type(e).__name__}: {str(e)}', time.time() - start
+    return session_key, None, time.time() - start
+
 
-    for skey in acquisition.Session.fetch('KEY'):
-        export_to_nwb(skey, nwb_output_dir=nwb_outdir, save=True)
+def export_sessions(session_keys, nwb_output_dir=default_nwb_output_dir, processes=None, **export_kwargs):
+    # export each of "session_keys" over a pool of "processes" worker processes
+    # (default: "export_processes" in dj.config['custom'], or 1) - a failed session is reported, not fatal
+    # "export_kwargs" are passed on to export_to_nwb (e.g. stream=True)
+    processes = processes or dj.config['custom'].get('export_processes', 1)
+    session_keys = list(session_keys)
+    print(f'Exporting {len(session_keys)} session(s) with {processes} worker(s)')
+
+    start = time.time()
+    failed = []
+    for count, (session_key, error, duration) in enumerate(utilities.parallel_map(
+            _export_session, [(k, nwb_output_dir, export_kwargs) for k in session_keys], processes=processes,
+            initializer=utilities.reset_connection if processes > 1 else None), start=1):
+        if error is not None:
+            failed.append((session_key, error))
+        elapsed = time.time() - start
+        print(f'[{count}/{len(session_keys)}] {"FAILED" if error else "Done"}: '
+              f'{session_key["subject_id"]} - {session_key["session_time"]} ({duration:.1f}s) '
+              f'- {count / elapsed * 60:.1f} sessions/min')
+
+    duration = time.time() - start
+    print('=================================')
+    print(f'Exported {len(session_keys) - len(failed)}/{len(session_keys)} session(s) in {duration / 60:.1f} min '
+          f'({processes} worker(s))')
+    for session_key, error in failed:
+        print(f'!!! FAILED: {session_key["subject_id"]} - {session_key["session_time"]} - {error}')
+    print('=================================')
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export every session of the pipeline to an NWB 2.0 file')
+    parser.add_argument('nwb_output_dir', nargs='?', default=default_nwb_output_dir,
+                        help=f'output directory (default: {default_nwb_output_dir})')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='number of worker processes, each exporting one session at a time (default: 1)')
+    parser.add_argument('-s', '--stream', action='store_true',
+                        help='write the traces chunked and compressed, fetching one trace at a time')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help=f'streaming chunk size in samples (default: {default_chunk_size})')
+    parser.add_argument('--compression-level', type=int, default=None, choices=range(10),
+                        help=f'streaming gzip compression level (default: {default_compression_level})')
+    args = parser.parse_args()
 
+    export_sessions(acquisition.Session.fetch('KEY'), nwb_output_dir=args.nwb_output_dir, processes=args.processes,
+                    stream=args.stream, chunk_size=args.chunk_size, compression_level=args.compression_level)
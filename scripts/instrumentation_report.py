@@ -0,0 +1,14 @@
+import os, sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pipeline import instrumentation
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the make() records of an instrumented populate')
+    parser.add_argument('jsonl_paths', nargs='+', help='JSON lines file(s) of make() records')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest keys listed per table (default: 5)')
+    args = parser.parse_args()
+
+    instrumentation.report(*args.jsonl_paths, top=args.top)
@@ -0,0 +1,41 @@
+import os, sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pipeline import launcher
+from populate import tables
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Start and supervise local workers populating the pipeline')
+    parser.add_argument('-n', '--workers', type=int, default=None,
+                        help='number of worker processes (default: number of cores)')
+    parser.add_argument('--heartbeat-interval', type=float, default=None,
+                        help='(s) interval of the heartbeat of the reservations of each worker (default: 30)')
+    parser.add_argument('--stale-timeout', type=float, default=None,
+                        help='(s) reservations without heartbeat for this long are reclaimed (default: 10 heartbeats)')
+    parser.add_argument('--shutdown-timeout', type=float, default=None,
+                        help='(s) on SIGTERM, time given to the workers to finish their batch (default: 600)')
+    parser.add_argument('--poll-interval', type=float, default=None,
+                        help='(s) interval at which an idle worker re-checks for keys while others are reserved '
+                             '(default: 10)')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record the timing, blob bytes and rows of each make() - see "instrumentation" in '
+                             'dj.config["custom"]')
+    parser.add_argument('--profile', nargs='*', default=None, metavar='TABLE',
+                        help='profile the make() of these tables (default: all) and keep the profiles of the calls '
+                             'slower than --profile-threshold - see "profiling" in dj.config["custom"]')
+    parser.add_argument('--profile-threshold', type=float, default=None,
+                        help='(s) keep the profiles of the make() calls taking at least this long (default: 0)')
+    args = parser.parse_args()
+
+    if args.instrument:
+        from pipeline import instrumentation
+        instrumentation.enable()
+    if args.profile is not None:
+        from pipeline import profiling
+        profiling.enable(tables=args.profile, threshold=args.profile_threshold)
+
+    launcher.launch_workers(tables, n_workers=args.workers, heartbeat_interval=args.heartbeat_interval,
+                            stale_timeout=args.stale_timeout, shutdown_timeout=args.shutdown_timeout,
+                            poll_interval=args.poll_interval)
@@ -1,24 +1,66 @@
 import os, sys
+import argparse
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from pipeline import intracellular, extracellular, analysis, behavior, stimulation
+from pipeline import acquisition, intracellular, extracellular, analysis, behavior, stimulation, scheduler
 
 
-settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False}
+tables = [
+    # ============= Trials =============
+    acquisition.TrialSet,
+    # ============= Extracellular =============
+    # -- Ingest unit spike times
+    extracellular.UnitSpikeTimes,
+    extracellular.UnitWaveformSummary,
+    # -- Unit location
+    extracellular.VMVALUnit,
+    extracellular.UnitSphericalRegion,
+    # -- UnitSpikeTimes trial-segmentation
+    analysis.RealignedEvent,
+    extracellular.TrialSegmentedUnitSpikeTimes,
+    extracellular.TrialSegmentedUnitSpikeRaster,
+    # ============= Intracellular =============
+    intracellular.MembranePotential,
+    intracellular.CurrentInjection,
+    # -- Behavioral
+    behavior.LickTrace,
+    # -- Perform trial segmentation
+    intracellular.TrialSegmentedMembranePotential,
+    intracellular.TrialSegmentedCurrentInjection,
+    stimulation.TrialSegmentedPhotoStimulus,
+    # -- (trial x sample) matrix per recording
+    intracellular.TrialSegmentedMembranePotentialMatrix,
+    intracellular.TrialSegmentedCurrentInjectionMatrix,
+    behavior.TrialSegmentedLickTraceMatrix,
+    stimulation.TrialSegmentedPhotoStimulusMatrix]
 
-# ============= Extracellular =============
-# -- Ingest unit spike times
-extracellular.UnitSpikeTimes.populate(**settings)
-# -- UnitSpikeTimes trial-segmentation
-analysis.RealignedEvent.populate(**settings)
-extracellular.TrialSegmentedUnitSpikeTimes.populate(**settings)
 
-# ============= Intracellular =============
-intracellular.MembranePotential.populate(**settings)
-intracellular.CurrentInjection.populate(**settings)
-# -- Behavioral
-behavior.LickTrace.populate(**settings)
-# -- Perform trial segmentation
-intracellular.TrialSegmentedMembranePotential.populate(**settings)
-intracellular.TrialSegmentedCurrentInjection.populate(**settings)
-stimulation.TrialSegmentedPhotoStimulus.populate(**settings)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Populate the imported and computed tables of the pipeline')
+    parser.add_argument('-w', '--workers', nargs='*', default=[], metavar='TABLE=N',
+                        help='number of worker processes of a table, e.g. extracellular.TrialSegmentedUnitSpikeTimes=4 '
+                             '(default: 1 per table)')
+    parser.add_argument('--serial', action='store_true',
+                        help='populate the tables one after the other in this process')
+    parser.add_argument('--instrument', action='store_true',
+                        help='record the timing, blob bytes and rows of each make() - see "instrumentation" in '
+                             'dj.config["custom"]')
+    parser.add_argument('--profile', nargs='*', default=None, metavar='TABLE',
+                        help='profile the make() of these tables (default: all) and keep the profiles of the calls '
+                             'slower than --profile-threshold - see "profiling" in dj.config["custom"]')
+    parser.add_argument('--profile-threshold', type=float, default=None,
+                        help='(s) keep the profiles of the make() calls taking at least this long (default: 0)')
+    args = parser.parse_args()
+
+    if args.instrument:
+        from pipeline import instrumentation
+        instrumentation.enable()
+    if args.profile is not None:
+        from pipeline import profiling
+        profiling.enable(tables=args.profile, threshold=args.profile_threshold)
+
+    if args.serial:
+        scheduler.populate_serially(tables)
+    else:
+        workers = {name: int(n) for name, n in (w.split('=') for w in args.workers)}
+        scheduler.populate_concurrently(tables, workers=workers)
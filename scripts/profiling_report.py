@@ -0,0 +1,18 @@
+import os, sys
+import argparse
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pipeline import profiling
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the slowest profiled make() calls and their top functions')
+    parser.add_argument('directory', help='directory of the profiles (see "profiling" in dj.config["custom"])')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest keys listed (default: 10)')
+    parser.add_argument('--functions', type=int, default=5,
+                        help='number of functions listed per key and per table (default: 5)')
+    parser.add_argument('--sort', choices=('tottime', 'cumtime'), default='tottime',
+                        help='rank the functions by own or cumulative time (default: tottime)')
+    args = parser.parse_args()
+
+    profiling.report(args.directory, top=args.top, functions=args.functions, sort=args.sort)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+'''
+Generate synthetic NWB 1.x files with the layout of the extracellular and whole-cell datasets of Guo, Inagaki et al.
+2017 - as read by the ingest scripts and the imported tables of the pipeline - to measure ingest, populate and export
+throughput without the real data files.
+
+    python scripts/synthetic_nwb.py ./data/synthetic --extracellular 4 --whole-cell 4 --trials 200
+'''
+import os
+import argparse
+from datetime import datetime, timedelta
+import numpy as np
+import h5py as h5
+
+
+vlen_str = h5.special_dtype(vlen=str)
+
+# default dataset dimensions - see the arguments of generate_dataset()
+defaults = dict(trials=100, trial_duration=5., units=20, spike_rate=10., waveform_samples=29, channels=32,
+                trace_fs=2000., seed=0)
+
+base_session_time = datetime(2017, 1, 2, 10, 0, 0)
+trial_responses = np.array(['Hit', 'Err', 'NoLick'])
+trial_sides = np.array(['L', 'R'])
+
+
+def _bytes(group, name, value):
+    # scalar string dataset read with ".value.decode('UTF-8')"
+    group.create_dataset(name, data=np.bytes_(value))
+
+
+def _str(group, name, value):
+    # scalar string dataset read with ".value" as a str
+    group.create_dataset(name, data=value, dtype=vlen_str)
+
+
+def _timeseries(group, name, data, fs, start_time=0.):
+    ts = group.create_group(name)
+    ts.create_dataset('data', data=data)
+    ts.create_dataset('timestamps', data=start_time + np.arange(len(data)) / fs)
+
+
+def _trial_times(trials, trial_duration):
+    # start/stop of back-to-back trials, and the events at fixed offsets within each trial
+    start_times = np.arange(trials) * trial_duration
+    return dict(start_time=start_times, stop_time=start_times + trial_duration,
+                pole_in=start_times + 0.1 * trial_duration, pole_out=start_times + 0.35 * trial_duration,
+                cue_start=start_times + 0.5 * trial_duration, cue_end=start_times + 0.5 * trial_duration + 0.1)
+
+
+def _epochs(nwb, times, trial_tags):
+    epochs = nwb.create_group('epochs')
+    for idx, tags in enumerate(trial_tags):
+        epoch = epochs.create_group(f'trial_{idx + 1:03d}')
+        epoch.create_dataset('tags', data=np.array(tags, dtype='S'))
+        epoch.create_dataset('start_time', data=times['start_time'][idx])
+        epoch.create_dataset('stop_time', data=times['stop_time'][idx])
+
+
+def _subject(nwb, subject_id, description, fields):
+    subject = nwb['general'].create_group('subject')
+    for name, value in dict(subject_id=subject_id, description=description, sex='Male', species='Mus musculus',
+                            age='P60', genotype='N/A', **fields).items():
+        _bytes(subject, name, value)
+
+
+def _general(nwb, session_note):
+    general = nwb.create_group('general')
+    _str(general, 'experiment_description', 'synthetic session')
+    _str(general, 'institution', 'Janelia Research Campus')
+    _bytes(general, 'related_publications', 'doi:10.1038/nature22324')
+    _bytes(general, 'surgery', 'N/A')
+    _str(general, 'experimenter', 'Nuo Li')
+    _str(nwb, 'nwb_version', 'NWB-1.0.6')
+    _str(nwb, 'session_description', session_note)
+    return general
+
+
+def write_extracellular_file(filepath, session_idx, trials, trial_duration, units, spike_rate, waveform_samples,
+                             channels, trace_fs, rng):
+    subject_id = f'anm{100000 + session_idx}'
+    session_time = (base_session_time + timedelta(days=session_idx)).strftime('%Y-%m-%dT%H:%M:%S')
+    times = _trial_times(trials, trial_duration)
+    duration = trials * trial_duration
+    # every other session recorded in the thalamus, in the contralateral hemisphere for every third one
+    brain_region = ('Contra ' if session_idx % 3 == 2 else '') + ('Thalamus' if session_idx % 2 else 'ALM')
+
+    with h5.File(filepath, 'w') as nwb:
+        _str(nwb, 'identifier', f'{subject_id}; {session_time}')
+        _str(nwb, 'session_start_time', session_time.replace('T', ' '))
+        general = _general(nwb, 'synthetic extracellular session')
+        _subject(nwb, subject_id, 'dateOfBirth: 2016-10-01\nanimalStrain: VGAT-ChR2-EYFP\nanimalSource: Jax\n', {})
+
+        # -- probe
+        devices = general.create_group('devices')
+        _bytes(devices, 'H-64', 'synthetic probe')
+        ephys = general.create_group('extracellular_ephys')
+        electrodes = np.zeros(channels, dtype=[('id', 'i4'), ('x', 'f8'), ('y', 'f8'), ('z', 'f8'), ('imp', 'f8'),
+                                               ('location', 'S64'), ('group', 'S16'), ('description', 'S16')])
+        electrodes['id'] = np.arange(channels)  # the units refer to their electrode by 1-based index
+        electrodes['z'] = np.arange(channels) * 0.025
+        electrodes['location'] = f"['{brain_region}']".encode()
+        electrodes['group'] = [f'shank{c // 8 + 1}'.encode() for c in range(channels)]
+        ephys.create_dataset('electrodes', data=electrodes)
+        ephys.create_dataset('ground_coordinates', data=np.array([0.95, -4.33, -1.5]))
+
+        # -- photostim site
+        site = general.create_group('optogenetics').create_group('site_1')
+        _bytes(site, 'description', 'synthetic photostimulation site')
+        _bytes(site, 'excitation_lambda', '473')
+        _bytes(site, 'location', 'atlas location: ALM\ncoordinates: [2.5, 1.5, 0.0]')
+        _bytes(site, 'stimulation_method', 'laser')
+
+        # -- trials
+        trial_tags = [[f'{r}{s}', 'good' if g else 'bad', 'PhotoStimulation' if stim else 'non-stimulation']
+                      for r, s, g, stim in zip(rng.choice(trial_responses, trials), rng.choice(trial_sides, trials),
+                                               rng.random_sample(trials) < 0.9, rng.random_sample(trials) < 0.25)]
+        _epochs(nwb, times, trial_tags)
+        presentation = nwb.create_group('stimulus').create_group('presentation')
+        for event, stimulus in (('cue_start', 'auditory_cue'), ('pole_in', 'pole_in'), ('pole_out', 'pole_out')):
+            presentation.create_group(stimulus).create_dataset('timestamps', data=times[event])
+        _timeseries(presentation, 'photostimulus_1', rng.random_sample(int(duration * trace_fs)), trace_fs)
+
+        analysis = nwb.create_group('analysis')
+        trial_type_mat = np.zeros((8, trials))
+        trial_type_mat[-5] = rng.randint(0, 4, trials)  # photostim period
+        trial_type_mat[-4] = rng.random_sample(trials) * 10  # power
+        trial_type_mat[-3:] = rng.random_sample((3, trials))  # galvo x, y, z
+        analysis.create_dataset('trial_type_mat', data=trial_type_mat)
+
+        # -- units
+        units_group = nwb.create_group('processing').create_group('extracellular_units')
+        event_waveform = units_group.create_group('EventWaveform')
+        unit_times = units_group.create_group('UnitTimes')
+        cell_types = []
+        for unit_idx in range(units):
+            unit_str = f'unit_{unit_idx + 1:02d}'
+            spike_times = np.sort(rng.random_sample(rng.poisson(spike_rate * duration)) * duration)
+            waveform = event_waveform.create_group(unit_str)
+            waveform.create_dataset('electrode_idx', data=np.array([rng.randint(1, channels + 1)]))
+            waveform.create_dataset('data', data=rng.standard_normal((len(spike_times), waveform_samples)))
+            unit = unit_times.create_group(unit_str)
+            unit.create_dataset('times', data=spike_times)
+            unit.create_dataset('depth', data=np.array([0.95, -4.33, -1.5]) + rng.standard_normal(3) * 0.3)
+            cell_types.append(f'{unit_str} - {"FS" if unit_idx % 4 == 0 else "pyramidal"}')
+        unit_times.create_dataset('cell_types', data=np.array(cell_types, dtype='S'))
+
+
+def write_wholecell_file(filepath, session_idx, trials, trial_duration, trace_fs, rng, **kwargs):
+    subject_id = f'anm{200000 + session_idx}'
+    session_time = (base_session_time + timedelta(days=session_idx)).strftime('%Y-%m-%d %H:%M:%S')
+    times = _trial_times(trials, trial_duration)
+    samples = int(trials * trial_duration * trace_fs)
+
+    with h5.File(filepath, 'w') as nwb:
+        _str(nwb, 'identifier', f'{subject_id}_{session_idx}')
+        _str(nwb, 'session_start_time', session_time)
+        general = _general(nwb, 'synthetic whole-cell session. Experiment type: behavior, intracellular')
+        _str(general, 'session_id', f'cell_{session_idx:04d}.nwb')
+        _subject(nwb, subject_id, 'Date of birth: 2016-10-01\nAnimal Strain: Gad2-IRES-Cre\nAnimal source: JAX\n',
+                 dict(weight='25g'))
+
+        devices = general.create_group('devices')
+        _bytes(devices, 'Amplifier', 'synthetic amplifier')
+        _bytes(devices, 'laser', 'synthetic laser')
+        whole_cell = general.create_group('intracellular_ephys').create_group('whole_cell')
+        _str(whole_cell, 'filtering', 'low-pass: 10kHz')
+        _str(whole_cell, 'location', 'AP 2.50, ML 1.50, DV 0.80, ALM')
+        _str(whole_cell, 'device', 'Amplifier')
+
+        site = general.create_group('optogenetics').create_group('site_1')
+        _bytes(site, 'description', 'synthetic photostimulation site')
+        _bytes(site, 'excitation_lambda', '473 nm')
+        _bytes(site, 'location', 'Contra ALM, coordinates: AP 2.50, ML 1.50, DV 0.00')
+
+        # -- trials
+        _epochs(nwb, times, [[] for _ in range(trials)])
+        presentation = nwb.create_group('stimulus').create_group('presentation')
+        for event in ('cue_start', 'cue_end', 'pole_in', 'pole_out'):
+            presentation.create_group(event).create_dataset('timestamps', data=times[event])
+        _timeseries(presentation, 'photostimulus', rng.random_sample(samples), trace_fs)
+
+        analysis = nwb.create_group('analysis')
+        trial_code = np.zeros((trials, 7), dtype=int)
+        trial_code[np.arange(trials), rng.randint(0, 6, trials)] = 1
+        trial_code[:, -1] = rng.random_sample(trials) < 0.25
+        analysis.create_dataset('trial_type_mat', data=trial_code)
+        analysis.create_dataset('good_trials', data=(rng.random_sample((1, trials)) < 0.9).astype(int))
+
+        # -- traces
+        timeseries = nwb.create_group('acquisition').create_group('timeseries')
+        membrane_potential = -60 + rng.standard_normal(samples)
+        _timeseries(timeseries, 'membrane_potential', membrane_potential, trace_fs)
+        _timeseries(timeseries, 'current_injection', rng.standard_normal(samples), trace_fs)
+        _timeseries(timeseries, 'lick_trace_L', rng.random_sample(samples), trace_fs)
+        _timeseries(timeseries, 'lick_trace_R', rng.random_sample(samples), trace_fs)
+        analysis.create_group('Vm_wo_spikes').create_group('membrane_potential_wo_spike').create_dataset(
+            'data', data=np.clip(membrane_potential, None, -50))
+
+
+def generate_dataset(output_dir, extracellular=1, whole_cell=1, **kwargs):
+    '''
+    Write "extracellular" and "whole_cell" synthetic session files in the "extracellular" and "whole_cell"
+    subdirectories of "output_dir" - return the paths of these two directories
+    "kwargs": trials, trial_duration (s), units, spike_rate (Hz), waveform_samples, channels, trace_fs (Hz), seed
+    '''
+    params = {**defaults, **kwargs}
+    rng = np.random.RandomState(params.pop('seed'))
+    directories = {}
+    for which_data, count, write_file in (('extracellular', extracellular, write_extracellular_file),
+                                          ('whole_cell', whole_cell, write_wholecell_file)):
+        directories[which_data] = os.path.join(output_dir, which_data)
+        os.makedirs(directories[which_data], exist_ok=True)
+        for session_idx in range(count):
+            write_file(os.path.join(directories[which_data], f'synthetic_{which_data}_{session_idx:04d}.nwb'),
+                       session_idx, rng=rng, **params)
+        print(f'Generated {count} {which_data} file(s) in {directories[which_data]}')
+    return directories
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic NWB 1.x files of the Guo-Inagaki 2017 datasets')
+    parser.add_argument('output_dir')
+    parser.add_argument('--extracellular', type=int, default=1, help='number of extracellular sessions (default: 1)')
+    parser.add_argument('--whole-cell', type=int, default=1, help='number of whole-cell sessions (default: 1)')
+    for name, value in defaults.items():
+        parser.add_argument(f'--{name.replace("_", "-")}', type=type(value), default=value,
+                            help=f'(default: {value})')
+    args = vars(parser.parse_args())
+
+    generate_dataset(**args)